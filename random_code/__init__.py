@@ -1,6 +1,12 @@
 from random_code.impl import (
+    corpus_report,
     find_files,
+    format_report,
     give_me_random_code,
+    iter_asts,
+    iter_sources,
     RandomCodeSource,
     nested_unpack,
+    SharedCorpus,
+    unbundle_corpus,
 )
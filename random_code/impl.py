@@ -1,61 +1,27 @@
 from ast import (
-    Assert,
-    Assign,
-    AugAssign,
     AST,
-    AsyncFor,
-    AsyncFunctionDef,
-    AsyncWith,
     Attribute,
     BinOp,
-    BoolOp,
+    BitOr,
     Break,
-    Call,
-    ClassDef,
-    Compare,
     comprehension,
     Constant,
-    Delete,
-    Dict,
-    DictComp,
     dump,
-    ExceptHandler,
-    Expr,
     fix_missing_locations,
-    For,
-    FormattedValue,
-    FunctionDef,
-    GeneratorExp,
-    If,
-    IfExp,
     Import,
     ImportFrom,
     Index,
-    JoinedStr,
-    keyword,
-    Lambda,
     List,
-    ListComp,
     Module,
     Name,
     NodeTransformer,
     NodeVisitor,
     parse,
     Pass,
-    Raise,
     Return,
-    Set,
-    SetComp,
-    Slice,
     Starred,
     Subscript,
-    Try,
     Tuple,
-    UnaryOp,
-    While,
-    With,
-    withitem,
-    Yield,
 )
 
 ### Feature List
@@ -124,19 +90,50 @@ except ImportError:
     # before python3.9's ast.unparse
     from astunparse import unparse
 
+try:
+    import numpy
+except ImportError:
+    # optional, for batch scope checks (see BagOfConcepts.batch_min_examples)
+    numpy = None
+
+try:
+    import _posixshmem
+except ImportError:
+    # Windows, where shared memory isn't tracked, see SharedCorpus.attach
+    _posixshmem = None
+
 
 def ast_unparse(ast):
     return unparse(fix_missing_locations(ast))
 
 
+import _ast
+import ast as ast_module
+import builtins
 import code
+import hashlib
 import logging
+import mmap
+import os
+import pickle
+import sys
+import tarfile
+import time
+import tracemalloc
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 from abc import ABC
-from collections import defaultdict, ChainMap, deque
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, ChainMap, Counter, deque
+from collections.abc import Mapping, MutableMapping
 from typing import List as tList, Dict as tDict
 from random import Random
-from functools import partial, wraps
+from functools import lru_cache, partial, wraps
+from types import MappingProxyType
 
 UnbundledElementsType = tDict[str, tDict[str, tList[AST]]]
 
@@ -161,11 +158,59 @@ class NotNameParent(ABC):
         return name in cls._doesnt_contain_names
 
 
+def _node_field_tables():
+    """
+    Split the running interpreter's node classes into the ones with fields, which the
+    UnbundlingVisitor collects examples of, and the fieldless ones (operators, contexts, Pass...)
+    it walks through. The deprecated aliases ast.py defines on top of _ast (Num, Str, ...) are
+    never produced by the parser and are left out
+    """
+    fields = {}
+    fieldless = set()
+    for name, node_class in vars(_ast).items():
+        if not isinstance(node_class, type) or not issubclass(node_class, AST):
+            continue
+        if len(node_class._fields) > 0:
+            fields[name] = tuple(node_class._fields)
+        elif node_class is not AST:
+            fieldless.add(name)
+    return fields, fieldless
+
+
+# node type -> fields that the UnbundlingVisitor collects examples of, and the node types that are
+# walked through without collecting examples
+_UNBUNDLED_FIELDS, _IGNORED_NODE_TYPES = _node_field_tables()
+
+# node types the parser only makes one instance of, which materialized trees share the same way
+_SHARED_NODE_TYPES = {
+    name
+    for name in _IGNORED_NODE_TYPES
+    if issubclass(
+        getattr(_ast, name),
+        (_ast.expr_context, _ast.boolop, _ast.operator, _ast.unaryop, _ast.cmpop),
+    )
+}
+
+
 class UnbundlingVisitor(NodeVisitor):
-    def __init__(self, *, max_depth=10000, log_level=None):
+    """
+    Collects the fields of every node of a type in _UNBUNDLED_FIELDS.
+
+    The walk uses an explicit stack instead of recursing through NodeVisitor.generic_visit, so
+    arbitrarily deep files don't hit the RecursionError limit, and dispatch is one lookup in the
+    static field table per node.
+    """
+
+    def __init__(self, *, max_depth=10000, log_level=None, on_example=None):
+        """
+        on_example: optional callback(node type name, node) for each node of a known type. When set,
+            it replaces appending the node's fields to the `visited` lists
+        """
         if log_level is not None:
             log.setLevel(log_level)
 
+        self.on_example = on_example
+
         self.depth = 0
         self.max_depth = max_depth
         self.missed_parents = set()
@@ -175,191 +220,94 @@ class UnbundlingVisitor(NodeVisitor):
         # easy to select and random body, type_ignores in the Module case
         # harder if you want to keep bodies and type_ignores paired
         self.visited = {
-            "alias": {"name": [], "asname": []},
-            "AnnAssign": {"target": [], "annotation": [], "value": [], "simple": []},
-            "arg": {"arg": [], "annotation": [], "type_comment": []},
-            "arguments": {
-                "posonlyargs": [],
-                "args": [],
-                "vararg": [],
-                "kwonlyargs": [],
-                "kw_defaults": [],
-                "kwarg": [],
-                "defaults": [],
-            },
-            "Assert": {"test": [], "msg": []},
-            "Assign": {"targets": [], "value": [], "type_comment": []},
-            "AsyncFunctionDef": {
-                "name": [],
-                "args": [],
-                "body": [],
-                "decorator_list": [],
-                "returns": [],
-                "type_comment": [],
-            },
-            "Attribute": {"value": [], "attr": [], "ctx": []},
-            "AugAssign": {"target": [], "op": [], "value": []},
-            "Await": {"value": []},
-            "BinOp": {"left": [], "right": [], "op": []},
-            "BoolOp": {"op": [], "values": []},
-            "Call": {"func": [], "args": [], "keywords": []},
-            "ClassDef": {
-                "name": [],
-                "bases": [],
-                "keywords": [],
-                "body": [],
-                "decorator_list": [],
-            },
-            "Compare": {"left": [], "ops": [], "comparators": []},
-            "comprehension": {"target": [], "iter": [], "ifs": [], "is_async": []},
-            "Constant": {"value": [], "kind": []},
-            "Delete": {"targets": []},
-            "Dict": {"keys": [], "values": []},
-            "DictComp": {"key": [], "value": [], "generators": []},
-            "ExceptHandler": {"type": [], "name": [], "body": []},
-            "Expr": {"value": []},
-            "For": {
-                "target": [],
-                "iter": [],
-                "body": [],
-                "orelse": [],
-                "type_comment": [],
-            },
-            "FormattedValue": {"value": [], "conversion": [], "format_spec": []},
-            "FunctionDef": {
-                "name": [],
-                "args": [],
-                "body": [],
-                "decorator_list": [],
-                "returns": [],
-                "type_comment": [],
-            },
-            "GeneratorExp": {"elt": [], "generators": []},
-            "Global": {"names": []},
-            "If": {"test": [], "body": [], "orelse": []},
-            "IfExp": {"test": [], "body": [], "orelse": []},
-            "Import": {"names": []},
-            "ImportFrom": {"module": [], "names": [], "level": []},
-            "Index": {"value": []},
-            "JoinedStr": {"values": []},
-            "keyword": {"arg": [], "value": []},
-            "Lambda": {"args": [], "body": []},
-            "List": {"elts": [], "ctx": []},
-            "ListComp": {"elt": [], "generators": []},
-            "Module": {"body": [], "type_ignores": []},
-            "Name": {"id": [], "ctx": []},
-            "Nonlocal": {"names": []},
-            "Raise": {"exc": [], "cause": []},
-            "Return": {"value": []},
-            "Set": {"elts": []},
-            "SetComp": {"elt": [], "generators": []},
-            "Slice": {"lower": [], "upper": [], "step": []},
-            "Starred": {"value": [], "ctx": []},
-            "Subscript": {"value": [], "slice": [], "ctx": []},
-            "Try": {"body": [], "handlers": [], "orelse": [], "finalbody": []},
-            "Tuple": {"elts": [], "ctx": []},
-            "TypeIgnore": {"lineno": [], "tag": []},
-            "UnaryOp": {"op": [], "operand": []},
-            "While": {"test": [], "body": [], "orelse": []},
-            "With": {"items": [], "body": [], "type_comment": []},
-            "withitem": {"context_expr": [], "optional_vars": []},
-            "Yield": {"value": []},
-            "YieldFrom": {"value": []},
+            node_type: {f: [] for f in fields}
+            for node_type, fields in _UNBUNDLED_FIELDS.items()
         }
-        self.ignore = [
-            "Add",
-            "Eq",
-            "IsNot",
-            "Load",
-            "Lt",
-            "LtE",
-            "Mult",
-            "Store",
-            "Sub",
-        ]
-        self.explore = ["Expr"]
-
-        for k in self.visited:
-            name = "visit_%s" % (k,)
-            setattr(self, name, self._helper_function_factory(k))
-
-        for k in self.ignore:
-            name = "visit_%s" % (k,)
-            setattr(self, name, self._ignore_function_factory(k))
-
-        for k in self.explore:
-            if k in self.visited or k in self.ignore:
-                continue
-            name = "visit_%s" % (k,)
-            setattr(self, name, self._explore_function_factory(k))
+        self.ignore = _IGNORED_NODE_TYPES
 
     def depth_padding(self):
         return " " * self.depth
 
-    def _helper_function_factory(self, node_name):
-        @depth_protection
-        def _visit_X(self, node_):
-            self._known_visit(node_name, node_)
-            self._post_visit(node_)
-
-        _visit_X.name = node_name
-        _visit_X.__name__ = node_name
-        return partial(_visit_X, self)
+    def visit(self, node):
+        fields_table = _UNBUNDLED_FIELDS
+        ignore = self.ignore
+        debug = log.isEnabledFor(logging.DEBUG)
 
-    def _ignore_function_factory(self, node_name):
-        @depth_protection
-        def _visit_X_ignore(self, node_):
-            self._post_visit(node_)
+        stack = [(node, 1)]
+        while len(stack) > 0:
+            node, depth = stack.pop()
+            self.depth = depth
+            name = type(node).__name__
 
-        _visit_X_ignore.name = node_name
-        _visit_X_ignore.__name__ = node_name
-        return partial(_visit_X_ignore, self)
+            if name in fields_table:
+                self._known_visit(name, node)
+            elif name not in ignore:
+                self._missed_visit(name, node)
 
-    def _explore_function_factory(self, node_name):
-        @depth_protection
-        def _visit_X_explore(self, node_):
-            self._explore_visit(node_name, node_)
-            self.generic_visit(node_)
+            if debug:
+                log.debug("%s Processed %s", self.depth_padding(), name)
 
-        _visit_X_explore.name = node_name
-        _visit_X_explore.__name__ = node_name
-        return partial(_visit_X_explore, self)
+            if depth >= self.max_depth:
+                log.warning(
+                    "UnbundlingVisitor: max_depth %d exceeded, not visiting below %s",
+                    self.max_depth,
+                    name,
+                )
+                continue
 
-    def _post_visit(self, node):
-        log.info(self.depth_padding() + " Processed " + type(node).__name__)
-        NodeVisitor.generic_visit(self, node)
+            # push children in reverse so they're popped in field order, as NodeVisitor would
+            children = []
+            for f in node._fields:
+                value = getattr(node, f, None)
+                if isinstance(value, list):
+                    for item in value:
+                        if isinstance(item, AST):
+                            children.append((item, depth + 1))
+                elif isinstance(value, AST):
+                    children.append((value, depth + 1))
+            children.reverse()
+            stack.extend(children)
 
-    def _explore_visit(self, name, node):
-        log.warning(self.depth_padding() + "Explore %s %s" % (name, dir(node)))
-        for k in sorted(list(dir(node))):
-            if not k.startswith("__"):
-                log.warning(self.depth_padding(), k, getattr(node, k))
-        log.warning(self.depth_padding() + "---")
+        self.depth = 0
 
     def _known_visit(self, name, nodex):
+        if self.on_example is not None:
+            self.on_example(name, nodex)
+            return
         for k in self.visited[name]:
             self.visited[name][k].append(getattr(nodex, k))
 
-    def unbundled(self):
-        return self.visited
-
-    def generic_visit(self, node):
+    def _missed_visit(self, name, node):
+        """
+        A node type the running interpreter doesn't know about (e.g. a custom AST subclass). Its
+        examples are collected like any other, and the type is recorded so it can be reported
+        """
         if len(node._fields) > 0:
-            if type(node).__name__ not in self.missed_parents:
-
-                def field_str(node):
-                    for f in node._fields:
-                        yield '"%s": []' % (f,)
-
+            if name not in self.missed_parents:
                 log.warning(
-                    self.depth_padding()
-                    + '"%s": {%s},' % (type(node).__name__, ",".join(field_str(node)))
+                    '%s"%s": (%s),',
+                    self.depth_padding(),
+                    name,
+                    ", ".join('"%s"' % (f,) for f in node._fields),
                 )
-            self.missed_parents.add(type(node).__name__)
+                if self.on_example is None:
+                    self.visited[name] = {f: [] for f in node._fields}
+            self.missed_parents.add(name)
+            self._known_visit(name, node)
         else:
-            self.missed_children.add(type(node).__name__)
+            self.missed_children.add(name)
+
+    def unbundled(self):
+        return self.visited
 
-        self._post_visit(node)
+
+def _check_missed(v: UnbundlingVisitor):
+    if len(v.missed_parents) > 0:
+        log.warning("Collected AST types missing from the field table")
+        log.warning(sorted(list(v.missed_parents)))
+    if len(v.missed_children) > 0:
+        log.warning("Walked through unknown AST types without fields")
+        log.warning(sorted(list(v.missed_children)))
 
 
 def unbundle_ast(ast: AST):
@@ -368,27 +316,52 @@ def unbundle_ast(ast: AST):
 
     result = v.unbundled()
 
-    try:
-        assert len(v.missed_parents) == 0
-    except AssertionError:
-        log.error("Missed AST types to handle")
-        log.error(sorted(list(v.missed_parents)))
-        log.error("Optional AST types to handle")
-        log.error(sorted(list(v.missed_children)))
-        raise
+    _check_missed(v)
 
     return result
 
 
-def merge_unbundled_asts(asts: tList[UnbundledElementsType]):
+def unbundle_to_table(ast: AST):
+    """
+    Like unbundle_ast, but stores the examples in a compact CorpusTable
+    """
+    table = CorpusTable()
+    memo = {}
+    examples = []
+
+    v = UnbundlingVisitor(on_example=lambda name, node: examples.append((name, node)))
+    v.visit(ast)
+
+    _check_missed(v)
+
+    # The examples come parents first. Working out their free names and returns the other way
+    # round means nested_unpack and contains_return find everything below an example already
+    # memoized, which keeps them linear and shallow on deeply nested code
+    names_memo = {}
+    returns_memo = {}
+    for _, node in reversed(examples):
+        free_names(node, names_memo)
+        contains_return(node, node, returns_memo)
+
+    for name, node in examples:
+        table.add_example(name, node, memo, names_memo, returns_memo)
+
+    return table
+
+
+def _merge_unbundled(unbundled, elements: UnbundledElementsType):
+    for ast_type, fields in elements.items():
+        if ast_type not in unbundled:
+            unbundled[ast_type] = defaultdict(list)
+        for k, list_of_vals in fields.items():
+            unbundled[ast_type][k].extend(list_of_vals)
+
+
+def merge_unbundled_asts(asts: tList[AST]):
     unbundled = {}
 
     for _map in asts:
-        for ast_type, elements in unbundle_ast(_map).items():
-            if ast_type not in unbundled:
-                unbundled[ast_type] = defaultdict(list)
-            for k, list_of_vals in elements.items():
-                unbundled[ast_type][k].extend(list_of_vals)
+        _merge_unbundled(unbundled, unbundle_ast(_map))
 
     for k in list(unbundled.keys()):
         unbundled[k] = dict(unbundled[k])
@@ -396,101 +369,1424 @@ def merge_unbundled_asts(asts: tList[UnbundledElementsType]):
     return unbundled
 
 
-class BagOfConcepts(object):
-    def __init__(self, corpus, seed=1):
-        self.corpus = corpus
+# Encoded field values are tagged integers: the low bits say what the rest of the value refers to
+_TAG_BITS = 3
+_TAG_MASK = (1 << _TAG_BITS) - 1
+_TAG_NONE = 0
+_TAG_NODE = 1  # node id
+_TAG_STR = 2  # index into CorpusTable.strings
+_TAG_CONST = 3  # index into CorpusTable.constants
+_TAG_LIST = 4  # offset into CorpusTable.list_items, which holds the length then the items
+_TAG_INT = 5  # small int stored inline
 
-        self.rng = Random(seed)
+_INLINE_INT_LIMIT = 1 << (63 - _TAG_BITS - 1)
 
-        for ast_element in self.corpus:
-            setattr(self, ast_element, self._strategy_strict_pairs(ast_element))
 
-    def _strategy_strict_pairs(self, node_name):
-        min_examples = min([len(v) for k, v in self.corpus[node_name].items()])
-        reference = self.corpus[node_name]
+def _child_asts(node: AST):
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if isinstance(value, AST):
+            yield value
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, AST):
+                    yield item
+
+
+class CorpusTable(object):
+    """
+    Compact storage for the corpus examples.
+
+    Instead of live AST objects, every node is a row in a flat table. Each node type has one typed
+    column (array of encoded values) per field, children are referenced by integer node id and
+    identifiers are interned.
+
+    Nodes are hash-consed: structurally identical subtrees (`self`, `None`, `self.x`, ...) are
+    stored once, no matter how many times they appear in the corpus. `examples` holds, per node
+    type, the distinct node ids that the UnbundlingVisitor collected and `weights` holds how many
+    times each one occurred. Real AST nodes are only built by `materialize`.
+
+    For compatibility, `table[node_type]` gives the same {field: [values]} mapping as
+    merge_unbundled_asts (materializing every occurrence, so it's for inspection rather than hot
+    paths)
+    """
+
+    # see wants_compaction
+    compact_factor = 2
+    # rows in the table when examples were first removed since it was last compact, or None
+    _compacted_rows = None
+
+    def __init__(self):
+        self.node_types = []  # type code -> AST class name
+        self.node_type = array("H")  # node id -> type code
+        self.node_row = array("I")  # node id -> row in the node type's columns
+        self.columns = {}  # AST class name -> {field: array of encoded values}
+        self.list_items = array("q")
+        self.strings = []
+        self.constants = []
+        self.examples = {}  # AST class name -> array of distinct node ids
+        self.weights = {}  # AST class name -> array of occurrence counts, as examples
+        self.free_names = {}  # AST class name -> array of name set ids, as examples
+        # AST class name -> array of string ids of the examples' annotation_key, as examples
+        self.type_keys = {}
+        # AST class name -> array of 1 for the examples with a nested Return (see contains_return)
+        # and 0 for the others, as examples
+        self.returns = {}
+        # name set id -> frozenset of the names an example needs in scope (see free_names), or
+        # None (id 0) if they aren't known
+        self.name_sets = [None]
+
+        self._build_indexes()
+
+    def _build_indexes(self):
+        self._type_codes = {name: code for code, name in enumerate(self.node_types)}
+        self._singletons = {}
+        # The interning and hash-consing indexes are only needed to add nodes, so they're built on
+        # first use. Tables that are only read (e.g. attached to a SharedCorpus) never pay for them
+        self._string_ids = None
+        self._constant_ids = None
+        self._node_ids = None
+        self._list_ids = None
+        self._example_positions = None
+        self._name_set_ids = None
+        self._subtree_sizes = None
+
+    def __getstate__(self):
+        # The lookup indexes are rebuilt on load, which keeps cache entries and IPC small
+        state = dict(self.__dict__)
+        for k in [
+            "_type_codes",
+            "_string_ids",
+            "_constant_ids",
+            "_singletons",
+            "_node_ids",
+            "_list_ids",
+            "_example_positions",
+            "_name_set_ids",
+            "_subtree_sizes",
+        ]:
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_indexes()
+
+    @classmethod
+    def from_unbundled(cls, unbundled: UnbundledElementsType):
+        """
+        Build a table from the {node type: {field: [values]}} output of merge_unbundled_asts
+        """
+        table = cls()
+        memo = {}
+        for node_type, fields in unbundled.items():
+            node_class = getattr(ast_module, node_type)
+            batch = sorted(list(fields.items()))
+            identifiers = [k for k, v in batch]
+            for data_pair in zip(*[v for k, v in batch]):
+                node = node_class(**{k: v for k, v in zip(identifiers, data_pair)})
+                table.add_example(node_type, node, memo)
+        return table
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __iter__(self):
+        return iter(self.examples)
+
+    def __contains__(self, node_type):
+        return node_type in self.examples
+
+    def keys(self):
+        return self.examples.keys()
+
+    def items(self):
+        for node_type in self.examples:
+            yield node_type, self[node_type]
+
+    def __getitem__(self, node_type):
+        occurrences = [
+            node_id
+            for node_id, weight in zip(self.examples[node_type], self.weights[node_type])
+            for _ in range(weight)
+        ]
+        fields = self.columns[node_type]
+        return {
+            field: [
+                self._decode(fields[field][self.node_row[node_id]])
+                for node_id in occurrences
+            ]
+            for field in fields
+        }
+
+    @staticmethod
+    def _constant_key(value):
+        if isinstance(value, (float, complex)):
+            # keeps -0.0 and 0.0 apart
+            return (type(value), repr(value))
+        return (type(value), value)
+
+    def _intern_string(self, value: str):
+        if self._string_ids is None:
+            self._string_ids = {s: i for i, s in enumerate(self.strings)}
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self._string_ids[value] = string_id
+        return string_id
+
+    def _intern_constant(self, value):
+        if self._constant_ids is None:
+            self._constant_ids = {
+                self._constant_key(c): i for i, c in enumerate(self.constants)
+            }
+        key = self._constant_key(value)
+        constant_id = self._constant_ids.get(key)
+        if constant_id is None:
+            constant_id = len(self.constants)
+            self.constants.append(value)
+            self._constant_ids[key] = constant_id
+        return constant_id
+
+    def _type_code(self, node_type: str, fields):
+        code = self._type_codes.get(node_type)
+        if code is None:
+            code = len(self.node_types)
+            self.node_types.append(node_type)
+            self._type_codes[node_type] = code
+            self.columns[node_type] = {f: array("q") for f in fields}
+        return code
+
+    def _list_at(self, offset: int):
+        length = self.list_items[offset]
+        return self.list_items[offset + 1 : offset + 1 + length]
+
+    def _fields_at(self, node_id: int):
+        node_type = self.node_types[self.node_type[node_id]]
+        row = self.node_row[node_id]
+        return [column[row] for column in self.columns[node_type].values()]
+
+    def _ensure_hash_indexes(self):
+        if self._node_ids is not None:
+            return
+        # hash -> id; the rare hash collisions between different contents go in a side table
+        # keyed by the contents themselves
+        self._node_ids = {}
+        self._node_collisions = {}
+        for node_id in range(len(self.node_type)):
+            key = (self.node_type[node_id], *self._fields_at(node_id))
+            self._node_ids.setdefault(hash(key), node_id)
+        self._list_ids = {}
+        self._list_collisions = {}
+        offset = 0
+        while offset < len(self.list_items):
+            items = tuple(self._list_at(offset))
+            self._list_ids.setdefault(hash(items), offset)
+            offset += 1 + len(items)
+
+    def _intern_list(self, items):
+        self._ensure_hash_indexes()
+        items = tuple(items)
+        key = hash(items)
+        offset = self._list_ids.get(key)
+        if offset is not None and tuple(self._list_at(offset)) == items:
+            return offset
+        offset = self._list_collisions.get(items) if offset is not None else None
+        if offset is not None:
+            return offset
+
+        offset = len(self.list_items)
+        self.list_items.append(len(items))
+        self.list_items.extend(items)
+        if key in self._list_ids:
+            self._list_collisions[items] = offset
+        else:
+            self._list_ids[key] = offset
+        return offset
+
+    def _encode(self, value, memo):
+        if value is None:
+            return _TAG_NONE
+        elif isinstance(value, AST):
+            return (memo[id(value)][0] << _TAG_BITS) | _TAG_NODE
+        elif isinstance(value, str):
+            return (self._intern_string(value) << _TAG_BITS) | _TAG_STR
+        elif isinstance(value, list):
+            offset = self._intern_list([self._encode(v, memo) for v in value])
+            return (offset << _TAG_BITS) | _TAG_LIST
+        elif type(value) is int and -_INLINE_INT_LIMIT <= value < _INLINE_INT_LIMIT:
+            return (value << _TAG_BITS) | _TAG_INT
+        else:
+            return (self._intern_constant(value) << _TAG_BITS) | _TAG_CONST
+
+    def _intern_row(self, node_type: str, encoded_fields):
+        """
+        Returns the id of the node with this type and these encoded fields, adding it if needed
+        """
+        self._ensure_hash_indexes()
+        code = self._type_codes[node_type]
+        key = (code, *encoded_fields)
+        key_hash = hash(key)
+        node_id = self._node_ids.get(key_hash)
+        if node_id is not None:
+            if (self.node_type[node_id], *self._fields_at(node_id)) == key:
+                return node_id
+            node_id = self._node_collisions.get(key)
+            if node_id is not None:
+                return node_id
+
+        fields = self.columns[node_type]
+        node_id = len(self.node_type)
+        self.node_type.append(code)
+        self.node_row.append(len(next(iter(fields.values()), ())))
+        for f, value in zip(fields, encoded_fields):
+            fields[f].append(value)
+
+        if key_hash in self._node_ids:
+            self._node_collisions[key] = node_id
+        else:
+            self._node_ids[key_hash] = node_id
+        return node_id
+
+    def _add_node(self, node: AST, memo):
+        # memo maps id(node) -> (node id, node) for the nodes already added from the same tree.
+        # Holding the node keeps its id from being reused while the memo is alive
+        seen = memo.get(id(node))
+        if seen is not None:
+            return seen[0]
+
+        # Post-order walk with an explicit stack, so children are interned before their parent
+        # and deep trees don't hit the recursion limit
+        stack = [(node, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if id(current) in memo:
+                continue
+            if not expanded:
+                stack.append((current, True))
+                for child in reversed(list(_child_asts(current))):
+                    if id(child) not in memo:
+                        stack.append((child, False))
+                continue
+
+            node_type = type(current).__name__
+            self._type_code(node_type, current._fields)
+            encoded_fields = [
+                self._encode(getattr(current, f, None), memo)
+                for f in self.columns[node_type]
+            ]
+            memo[id(current)] = (self._intern_row(node_type, encoded_fields), current)
+        return memo[id(node)][0]
+
+    def _ensure_example_positions(self):
+        if self._example_positions is None:
+            self._example_positions = {
+                k: {node_id: i for i, node_id in enumerate(ids)}
+                for k, ids in self.examples.items()
+            }
+
+    def _intern_name_set(self, names):
+        if self._name_set_ids is None:
+            self._name_set_ids = {
+                names: name_set_id for name_set_id, names in enumerate(self.name_sets)
+            }
+        name_set_id = self._name_set_ids.get(names)
+        if name_set_id is None:
+            name_set_id = len(self.name_sets)
+            self.name_sets.append(names)
+            self._name_set_ids[names] = name_set_id
+        return name_set_id
+
+    def _count_example(
+        self,
+        node_type: str,
+        node_id: int,
+        count: int,
+        names,
+        type_key: str,
+        returns: bool,
+    ):
+        """
+        names: called for the example's free names when it's new to the table
+        type_key: the example's annotation_key
+        returns: whether the example contains a Return
+        """
+        self._ensure_example_positions()
+        if node_type not in self.examples:
+            self.examples[node_type] = array("I")
+            self.weights[node_type] = array("I")
+            self.free_names[node_type] = array("I")
+            self.type_keys[node_type] = array("I")
+            self.returns[node_type] = array("B")
+            self._example_positions[node_type] = {}
+
+        positions = self._example_positions[node_type]
+        position = positions.get(node_id)
+        if position is None:
+            positions[node_id] = len(self.examples[node_type])
+            self.examples[node_type].append(node_id)
+            self.weights[node_type].append(count)
+            self.free_names[node_type].append(self._intern_name_set(names()))
+            self.type_keys[node_type].append(self._intern_string(type_key))
+            self.returns[node_type].append(returns)
+        else:
+            self.weights[node_type][position] += count
+
+    def add_example(
+        self, node_type: str, node: AST, memo=None, names_memo=None, returns_memo=None
+    ):
+        """
+        Add a node (and its subtree) to the table and count it as an example of node_type
+
+        memo: dict shared between calls for nodes from the same tree so shared subtrees are only
+            added once
+        names_memo: dict shared between calls for nodes from the same tree, see free_names
+        returns_memo: dict shared between calls for nodes from the same tree, see contains_return
+        """
+        if memo is None:
+            memo = {}
+        node_id = self._add_node(node, memo)
+        self._count_example(
+            node_type,
+            node_id,
+            1,
+            lambda: free_names(node, names_memo),
+            annotation_key(getattr(node, "annotation", None)),
+            contains_return(node, node, returns_memo),
+        )
+        return node_id
+
+    def extend(self, other: "CorpusTable"):
+        """
+        Add the nodes and examples of another table (e.g. a single file's table) to this one
+
+        Returns {node type: {node id in this table: occurrences added}}, which remove_examples
+        takes to undo the extend
+        """
+        node_ids = self._copy_nodes(other, range(len(other.node_type)))
+        return self._copy_examples(other, node_ids)
+
+    def _copy_nodes(self, other: "CorpusTable", other_ids):
+        """
+        Add the rows of other's nodes other_ids, which have to come after their children (as
+        node ids do). Returns {node id in other: node id in this table}
+        """
+        node_ids = {}
+        for node_id in other_ids:
+            node_type = other.node_types[other.node_type[node_id]]
+            other_fields = other.columns[node_type]
+            self._type_code(node_type, other_fields)
+            row = other.node_row[node_id]
+            encoded_fields = [
+                self._remap(other, other_fields[f][row], node_ids)
+                for f in self.columns[node_type]
+            ]
+            node_ids[node_id] = self._intern_row(node_type, encoded_fields)
+        return node_ids
+
+    def _copy_examples(self, other: "CorpusTable", node_ids):
+        added = {}
+        for node_type, examples in other.examples.items():
+            added[node_type] = {}
+            for node_id, weight, name_set_id, type_key_id, returns in zip(
+                examples,
+                other.weights[node_type],
+                other.free_names[node_type],
+                other.type_keys[node_type],
+                other.returns[node_type],
+            ):
+                names = other.name_sets[name_set_id]
+                self._count_example(
+                    node_type,
+                    node_ids[node_id],
+                    weight,
+                    lambda: names,
+                    other.strings[type_key_id],
+                    returns,
+                )
+                added[node_type][node_ids[node_id]] = weight
+        return added
+
+    def _remap(self, other: "CorpusTable", value: int, node_ids):
+        tag = value & _TAG_MASK
+        payload = value >> _TAG_BITS
+        if tag == _TAG_NODE:
+            return (node_ids[payload] << _TAG_BITS) | _TAG_NODE
+        elif tag == _TAG_STR:
+            return (self._intern_string(other.strings[payload]) << _TAG_BITS) | _TAG_STR
+        elif tag == _TAG_CONST:
+            constant_id = self._intern_constant(other.constants[payload])
+            return (constant_id << _TAG_BITS) | _TAG_CONST
+        elif tag == _TAG_LIST:
+            items = [
+                self._remap(other, item, node_ids) for item in other._list_at(payload)
+            ]
+            return (self._intern_list(items) << _TAG_BITS) | _TAG_LIST
+        return value
+
+    def remove_examples(self, removed):
+        """
+        Remove example occurrences. Nodes stay in the table, but the ones whose weight drops to zero
+        are no longer sampled, until compact drops them (see wants_compaction)
+
+        removed: {node type: {node id: occurrences}}, as returned by extend
+        """
+        if self._compacted_rows is None:
+            self._compacted_rows = len(self.node_type)
+        self._ensure_example_positions()
+        for node_type, counts in removed.items():
+            positions = self._example_positions[node_type]
+            examples = self.examples[node_type]
+            weights = self.weights[node_type]
+            names = self.free_names[node_type]
+            type_keys = self.type_keys[node_type]
+            returns = self.returns[node_type]
+            for node_id, count in counts.items():
+                position = positions[node_id]
+                weights[position] -= count
+                if weights[position] > 0:
+                    continue
+                # swap the last example into the empty slot
+                del positions[node_id]
+                last = len(examples) - 1
+                if position != last:
+                    examples[position] = examples[last]
+                    weights[position] = weights[last]
+                    names[position] = names[last]
+                    type_keys[position] = type_keys[last]
+                    returns[position] = returns[last]
+                    positions[examples[position]] = position
+                del examples[last]
+                del weights[last]
+                del names[last]
+                del type_keys[last]
+                del returns[last]
+
+            if len(examples) == 0:
+                del self.examples[node_type]
+                del self.weights[node_type]
+                del self.free_names[node_type]
+                del self.type_keys[node_type]
+                del self.returns[node_type]
+                del self._example_positions[node_type]
+
+    def close(self):
+        """
+        Release the segment or file an attached table maps (see SharedCorpus.attach). The table
+        can't be used afterwards. Does nothing for other tables
+        """
+        mapping = self.__dict__.pop("_shared_mapping", None)
+        if mapping is None:
+            return
+        for view in self.__dict__.pop("_shared_views"):
+            view.release()
+        mapping.close()
+
+    def wants_compaction(self):
+        """
+        Whether examples were removed and the table has grown compact_factor times over since it
+        was last compact, so that compacting it keeps its size bounded at an amortized O(1) cost
+        per row added
+        """
+        return self._compacted_rows is not None and len(self.node_type) >= max(
+            self.compact_factor * self._compacted_rows, 1
+        )
+
+    def compact(self):
+        """
+        Rebuild the table from its examples, dropping the nodes, lists, strings, constants and name
+        sets that only removed examples used. Examples keep their order, but node ids and name set
+        ids change
+
+        Returns {old node id: new node id} for the nodes that are kept
+        """
+        live = set()
+        stack = [node_id for ids in self.examples.values() for node_id in ids]
+        while stack:
+            node_id = stack.pop()
+            if node_id not in live:
+                live.add(node_id)
+                stack.extend(self._child_ids(node_id))
+
+        table = CorpusTable()
+        node_ids = table._copy_nodes(self, sorted(live))
+        table._copy_examples(self, node_ids)
+        self.__dict__.update(table.__dict__)
+        self._compacted_rows = None
+        return node_ids
+
+    def _decode(self, value: int, children=None):
+        """
+        Decode a field value. Nested nodes are taken from ``children`` (an iterator over the
+        already built child nodes, in field order) or materialized on the spot
+        """
+        tag = value & _TAG_MASK
+        payload = value >> _TAG_BITS
+        if tag == _TAG_NODE:
+            return self.materialize(payload) if children is None else next(children)
+        elif tag == _TAG_STR:
+            return self.strings[payload]
+        elif tag == _TAG_INT:
+            return payload
+        elif tag == _TAG_LIST:
+            return [self._decode(item, children) for item in self._list_at(payload)]
+        elif tag == _TAG_CONST:
+            return self.constants[payload]
+        return None
+
+    def _child_ids(self, node_id: int):
+        node_type = self.node_types[self.node_type[node_id]]
+        row = self.node_row[node_id]
+        for column in self.columns[node_type].values():
+            value = column[row]
+            tag = value & _TAG_MASK
+            if tag == _TAG_NODE:
+                yield value >> _TAG_BITS
+            elif tag == _TAG_LIST:
+                for item in self._list_at(value >> _TAG_BITS):
+                    if item & _TAG_MASK == _TAG_NODE:
+                        yield item >> _TAG_BITS
+
+    def subtree_sizes(self, node_ids):
+        """
+        Number of nodes in the subtree of each of the nodes, counting shared subtrees once per
+        occurrence, as they are once materialized. Sizes are cached, rows never change once added
+        """
+        if self._subtree_sizes is None:
+            self._subtree_sizes = {}
+        sizes = self._subtree_sizes
+
+        for node_id in node_ids:
+            stack = [(node_id, False)]
+            while stack:
+                current, expanded = stack.pop()
+                if current in sizes:
+                    continue
+                child_ids = list(self._child_ids(current))
+                if not expanded:
+                    stack.append((current, True))
+                    stack.extend((child, False) for child in child_ids)
+                else:
+                    sizes[current] = 1 + sum(sizes[child] for child in child_ids)
+        return [sizes[node_id] for node_id in node_ids]
+
+    def materialize(self, node_id: int):
+        """
+        Build a fresh AST for the node (and its subtree), so nothing done to it can reach the
+        corpus or another candidate. Contexts and operators (Load, Add, ...) are shared instances,
+        as they are from the parser
+        """
+        # Post-order walk with an explicit stack: every occurrence of a shared row gets its own
+        # node, and the built nodes wait on ``built`` until their parent pops them
+        built = []
+        stack = [(node_id, None)]
+        while stack:
+            current, child_count = stack.pop()
+            node_type = self.node_types[self.node_type[current]]
+            fields = self.columns[node_type]
+
+            if len(fields) == 0:
+                if node_type not in _SHARED_NODE_TYPES:
+                    # statements like Pass get scopes attached during generation
+                    built.append(getattr(ast_module, node_type)())
+                    continue
+                if node_type not in self._singletons:
+                    self._singletons[node_type] = getattr(ast_module, node_type)()
+                built.append(self._singletons[node_type])
+                continue
+
+            if child_count is None:
+                child_ids = list(self._child_ids(current))
+                stack.append((current, len(child_ids)))
+                stack.extend((child, None) for child in reversed(child_ids))
+                continue
+
+            start = len(built) - child_count
+            children = iter(built[start:])
+            del built[start:]
+            row = self.node_row[current]
+            values = {f: self._decode(column[row], children) for f, column in fields.items()}
+            built.append(getattr(ast_module, node_type)(**values))
+        return built[0]
+
+
+_SHARED_CORPUS_MAGIC = b"RANDCODE"
+_SHARED_CORPUS_VERSION = 4
+_SHARED_CORPUS_ALIGN = 8
+
+
+def _shared_corpus_arrays(table: CorpusTable):
+    yield ("node_type",), table.node_type
+    yield ("node_row",), table.node_row
+    yield ("list_items",), table.list_items
+    for node_type, fields in table.columns.items():
+        for field, column in fields.items():
+            yield ("column", node_type, field), column
+    for node_type in table.examples:
+        yield ("examples", node_type), table.examples[node_type]
+        yield ("weights", node_type), table.weights[node_type]
+        yield ("free_names", node_type), table.free_names[node_type]
+        yield ("type_keys", node_type), table.type_keys[node_type]
+        yield ("returns", node_type), table.returns[node_type]
+
+
+def _serialize_corpus(table: CorpusTable):
+    """
+    Lay a table out as: magic, header length, pickled header, then the raw array data. The header
+    holds the small pieces (type names, strings, constants) and where each array lives
+    """
+    layout = []
+    offset = 0
+    for key, values in _shared_corpus_arrays(table):
+        nbytes = len(values) * values.itemsize
+        layout.append((key, values.typecode, offset, len(values)))
+        offset += nbytes + (-nbytes % _SHARED_CORPUS_ALIGN)
+
+    header = pickle.dumps(
+        {
+            "version": _SHARED_CORPUS_VERSION,
+            "node_types": table.node_types,
+            "column_fields": {k: list(v) for k, v in table.columns.items()},
+            "strings": table.strings,
+            "constants": table.constants,
+            "name_sets": table.name_sets,
+            "layout": layout,
+        },
+        protocol=pickle.HIGHEST_PROTOCOL,
+    )
+    data_start = len(_SHARED_CORPUS_MAGIC) + 8 + len(header)
+    data_start += -data_start % _SHARED_CORPUS_ALIGN
+    return header, layout, data_start, data_start + offset
+
+
+def _write_corpus(table: CorpusTable, buf, serialized):
+    header, layout, data_start, size = serialized
+    prefix = _SHARED_CORPUS_MAGIC + len(header).to_bytes(8, "little") + header
+    buf[: len(prefix)] = prefix
+    for (key, values), (_, _, offset, _) in zip(_shared_corpus_arrays(table), layout):
+        raw = memoryview(values).cast("B")
+        buf[data_start + offset : data_start + offset + len(raw)] = raw
+
+
+def _read_corpus(buf):
+    """
+    Build a CorpusTable whose arrays are read-only views into buf, without copying them
+    """
+    buf = memoryview(buf).toreadonly()
+    magic_end = len(_SHARED_CORPUS_MAGIC)
+    if bytes(buf[:magic_end]) != _SHARED_CORPUS_MAGIC:
+        raise ValueError("Not a shared corpus")
+    header_length = int.from_bytes(buf[magic_end : magic_end + 8], "little")
+    header = pickle.loads(buf[magic_end + 8 : magic_end + 8 + header_length])
+    if header["version"] != _SHARED_CORPUS_VERSION:
+        raise ValueError("Unsupported shared corpus version %s" % (header["version"],))
+    data_start = magic_end + 8 + header_length
+    data_start += -data_start % _SHARED_CORPUS_ALIGN
+
+    arrays = {}
+    for key, typecode, offset, length in header["layout"]:
+        itemsize = array(typecode).itemsize
+        start = data_start + offset
+        arrays[key] = buf[start : start + length * itemsize].cast(typecode)
+
+    table = CorpusTable.__new__(CorpusTable)
+    table.node_types = header["node_types"]
+    table.node_type = arrays[("node_type",)]
+    table.node_row = arrays[("node_row",)]
+    table.list_items = arrays[("list_items",)]
+    table.columns = {
+        node_type: {field: arrays[("column", node_type, field)] for field in fields}
+        for node_type, fields in header["column_fields"].items()
+    }
+    table.strings = header["strings"]
+    table.constants = header["constants"]
+    table.name_sets = header["name_sets"]
+    table.examples = {}
+    table.weights = {}
+    table.free_names = {}
+    table.type_keys = {}
+    table.returns = {}
+    for key in arrays:
+        if key[0] == "examples":
+            table.examples[key[1]] = arrays[key]
+            table.weights[key[1]] = arrays[("weights", key[1])]
+            table.free_names[key[1]] = arrays[("free_names", key[1])]
+            table.type_keys[key[1]] = arrays[("type_keys", key[1])]
+            table.returns[key[1]] = arrays[("returns", key[1])]
+    table._build_indexes()
+    # released by close, so the mapping they point into can be
+    table._shared_views = [buf, *arrays.values()]
+    return table
+
+
+class SharedCorpus(object):
+    """
+    A CorpusTable laid out in one read-only segment that other processes can attach to without
+    copying it: shared memory by default or, if a path is given, an mmap'd file (which also
+    survives restarts). Pass `name`, or `path=path` for a file, to RandomCodeSource.attach in
+    each worker process.
+
+    The creating process owns the segment and should call unlink() once no more workers will
+    attach
+    """
+
+    def __init__(self, table: CorpusTable, *, path=None):
+        serialized = _serialize_corpus(table)
+        size = serialized[-1]
+        self.path = path
+        self._shm = None
+
+        if path is not None:
+            with open(path, "wb") as f:
+                f.truncate(size)
+            with open(path, "r+b") as f:
+                with mmap.mmap(f.fileno(), size) as buf:
+                    _write_corpus(table, buf, serialized)
+            self.name = None
+        else:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            _write_corpus(table, self._shm.buf, serialized)
+            self.name = self._shm.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+
+    def unlink(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    @staticmethod
+    def attach(name: str = None, *, path: str = None):
+        """
+        Returns a read-only CorpusTable backed by the shared memory segment called name or, given
+        a path instead, by the file a SharedCorpus was written to. Its close() releases them
+        """
+        if (name is None) == (path is None):
+            raise ValueError("Attach to either a shared memory name or a path")
+        if path is not None:
+            with open(path, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = mapping
+        else:
+            try:
+                mapping = shared_memory.SharedMemory(name=name, track=False)
+                buf = mapping.buf
+            except TypeError:
+                # before python3.13, attaching also registers the segment for cleanup at exit.
+                # Unregistering afterwards isn't enough: forked workers share the creator's
+                # resource tracker, and would drop its registration too
+                mapping = _map_shared_memory(name)
+                buf = mapping if isinstance(mapping, mmap.mmap) else mapping.buf
+        table = _read_corpus(buf)
+        # the table's arrays are views into the mapping, so it has to live as long as the table
+        table._shared_mapping = mapping
+        return table
+
+
+def _map_shared_memory(name: str):
+    """
+    Read-only mapping of the shared memory segment called name, without registering it with
+    the resource tracker
+    """
+    if _posixshmem is None:
+        # only POSIX segments are tracked
+        return shared_memory.SharedMemory(name=name)
+    # the way SharedMemory opens it, minus the registration
+    fd = _posixshmem.shm_open("/" + name, os.O_RDONLY, mode=0o600)
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
 
-        batch = sorted(list(reference.items()))
-        identifiers = [k for k, v in batch]
-        data_lists = [v for k, v in batch]
 
-        common_data_pairs = list(zip(*data_lists))
+class NameBits(object):
+    """
+    Numbers the names that corpus examples need in scope (see CorpusTable.name_sets), so that
+    sets of them are bitsets: ints with bit n set for the name numbered n
+    """
 
-        def _visit_strict_pairs():
-            self.rng.shuffle(common_data_pairs)
-            for data_pair in common_data_pairs:
-                kwargs = {k: v for k, v in zip(identifiers, data_pair)}
+    # fixed mappings whose bitsets are kept, see fixed_mask
+    max_fixed_masks = 64
+
+    def __init__(self):
+        self.bits = {}  # name -> bit number
+        # name set id -> bitset of its names, or None where they aren't known
+        self.masks = []
+        # id(mapping) -> (mapping, bitset of its names), see fixed_mask
+        self._fixed_masks = {}
+
+    def reset(self):
+        """
+        Forget every name set and name, for when the name sets are renumbered
+        """
+        self.bits.clear()
+        self.masks.clear()
+        self._fixed_masks.clear()
+
+    def update(self, name_sets):
+        """
+        Number the names of the name sets added since the last update
+        """
+        numbered = len(self.bits)
+        for names in name_sets[len(self.masks) :]:
+            if names is None:
+                self.masks.append(None)
+                continue
+            mask = 0
+            for name in names:
+                bit = self.bits.get(name)
+                if bit is None:
+                    bit = len(self.bits)
+                    self.bits[name] = bit
+                mask |= 1 << bit
+            self.masks.append(mask)
+        if len(self.bits) != numbered:
+            # names in them may have been given bits
+            self._fixed_masks.clear()
+
+    def fixed_mask(self, mapping):
+        """
+        Bitset of the names of a mapping that doesn't change, like a Scope's fixed frames
+        """
+        entry = self._fixed_masks.get(id(mapping))
+        if entry is None:
+            mask = 0
+            for name in mapping:
+                bit = self.bits.get(name)
+                if bit is not None:
+                    mask |= 1 << bit
+            if len(self._fixed_masks) >= self.max_fixed_masks:
+                self._fixed_masks.clear()
+            # keeping the mapping alive keeps its id from being reused
+            entry = (mapping, mask)
+            self._fixed_masks[id(mapping)] = entry
+        return entry[1]
+
+    def matrix(self, name_set_ids):
+        """
+        The bitsets of name_set_ids as the rows of a numpy matrix of 64 bit words, for
+        batch_fits. Unknown name sets get an empty row
+        """
+        words = max(1, (len(self.bits) + 63) // 64)
+        matrix = numpy.zeros((len(name_set_ids), words), dtype=numpy.uint64)
+        for row, name_set_id in enumerate(name_set_ids):
+            mask = self.masks[name_set_id]
+            if mask:
+                matrix[row] = _mask_words(mask, words)
+        return matrix
+
+
+def _mask_words(mask: int, words: int):
+    mask &= (1 << (64 * words)) - 1
+    return numpy.frombuffer(mask.to_bytes(8 * words, "little"), dtype="<u8")
+
+
+def batch_fits(matrix, scope_mask: int):
+    """
+    For each row of a NameBits.matrix, whether all of its names are in scope_mask. One
+    vectorized operation, however many rows there are
+    """
+    missing = matrix & ~_mask_words(scope_mask, matrix.shape[1])
+    return ~missing.any(axis=1)
 
-                import ast
 
-                yield getattr(ast, node_name)(**kwargs)
+class BagOfConcepts(object):
+    # number of examples from which, with numpy installed, a node type's candidates are all
+    # checked against the scope in one batch rather than one by one as they're drawn. None to
+    # never batch
+    batch_min_examples = 4096
+
+    def __init__(
+        self, corpus, seed=1, *, program=0, weighting="frequency", temperature=1.0
+    ):
+        """
+        corpus: a CorpusTable, or the {node type: {field: [values]}} output of
+            merge_unbundled_asts which is converted to one
+        program: which program's random streams to draw from, see for_program
+        weighting: how likely each distinct example is to come up first:
+            "frequency": proportional to how often it occurs in the corpus
+            "uniform": all equally likely
+            "size": inversely proportional to the size of its subtree, favouring small examples
+            or a callable(node type, node id, occurrences) -> weight >= 0
+        temperature: weights are raised to 1 / temperature. Above 1 flattens them towards
+            uniform, below 1 sharpens them, and negative temperatures favour the rare examples
+        """
+        if not isinstance(corpus, CorpusTable):
+            corpus = CorpusTable.from_unbundled(corpus)
+        self.corpus = corpus
+
+        if weighting not in _WEIGHTINGS and not callable(weighting):
+            raise ValueError("Unknown weighting %r" % (weighting,))
+        if temperature == 0:
+            raise ValueError("temperature can't be 0")
+
+        self.seed = seed
+        self.program = program
+        self.weighting = weighting
+        self.temperature = temperature
+        # node type -> Random, see stream
+        self._streams = {}
+        # node type -> _SamplingTable, shared with the for_program views
+        self._sampling_tables = {}
+        # shared with the for_program views too, see name_bits
+        self._name_bits = NameBits()
+
+    def for_program(self, program: int):
+        """
+        A view of the same corpus whose draws come from the streams of program number `program`,
+        so the program generated from it only depends on (seed, program) and not on what was
+        generated before it, or in which thread or process
+        """
+        view = BagOfConcepts(
+            self.corpus,
+            seed=self.seed,
+            program=program,
+            weighting=self.weighting,
+            temperature=self.temperature,
+        )
+        view._sampling_tables = self._sampling_tables
+        view._name_bits = self._name_bits
+        return view
+
+    def name_bits(self):
+        """
+        The NameBits of the corpus' names, for Scopes to keep bitsets with
+        """
+        self._name_bits.update(self.corpus.name_sets)
+        return self._name_bits
+
+    def stream(self, node_name: str):
+        """
+        The random stream candidates of this node type are drawn from. Streams are split off the
+        seed by (program, node type), so draws for one node type never shift the others
+        """
+        rng = self._streams.get(node_name)
+        if rng is None:
+            rng = Random(_stream_seed(self.seed, self.program, node_name))
+            self._streams[node_name] = rng
+        return rng
+
+    def __getattr__(self, node_name):
+        # Strategies are built on first use, so startup and memory scale with the node types a
+        # generation run actually touches rather than with every type in the corpus
+        if node_name.startswith("_") or "corpus" not in self.__dict__:
+            raise AttributeError(node_name)
+        if node_name not in self.corpus:
+            raise AttributeError(node_name)
+
+        strategy = self._strategy_strict_pairs(node_name)
+        setattr(self, node_name, strategy)
+        return strategy
+
+    def _invalidate(self, node_name):
+        self.__dict__.pop(node_name, None)
+        self._sampling_tables.pop(node_name, None)
+
+    def add_elements(self, unbundled):
+        """
+        Append each of the unbundled elements (CorpusTables, e.g. one per file) to the corpus,
+        invalidating the affected strategies
+
+        Returns what CorpusTable.extend returned for each of the elements, for remove_elements
+        """
+        changed = set()
+        added = []
+        for elements in unbundled:
+            if not isinstance(elements, CorpusTable):
+                elements = CorpusTable.from_unbundled(elements)
+            added.append(self.corpus.extend(elements))
+            changed.update(elements.keys())
+
+        for node_type in changed:
+            self._invalidate(node_type)
+
+        return added
+
+    def remove_elements(self, removed):
+        """
+        Remove examples from the corpus, invalidating the affected strategies
+
+        removed: {node type: {node id: occurrences}}, as returned by add_elements
+        """
+        self.corpus.remove_examples(removed)
+
+        for node_type in removed:
+            self._invalidate(node_type)
+
+    def compact(self):
+        """
+        Compact the corpus (see CorpusTable.compact), invalidating every strategy
+
+        Returns {old node id: new node id}, as CorpusTable.compact
+        """
+        node_types = list(self.corpus.node_types)
+        node_ids = self.corpus.compact()
+        for node_type in node_types:
+            self._invalidate(node_type)
+        # the name sets are renumbered
+        self._name_bits.reset()
+        return node_ids
+
+    def _example_weights(self, node_name: str, example_ids):
+        occurrences = self.corpus.weights[node_name]
+        if self.weighting == "frequency":
+            weights = list(occurrences)
+        elif self.weighting == "uniform":
+            weights = [1] * len(example_ids)
+        elif self.weighting == "size":
+            weights = [1.0 / size for size in self.corpus.subtree_sizes(example_ids)]
+        else:
+            weights = [
+                self.weighting(node_name, node_id, count)
+                for node_id, count in zip(example_ids, occurrences)
+            ]
+
+        if any(w < 0 for w in weights):
+            raise ValueError("Negative weight for a %s example" % (node_name,))
+        if self.temperature != 1:
+            exponent = 1.0 / self.temperature
+            weights = [w**exponent if w > 0 else 0.0 for w in weights]
+        return weights
+
+    def _sampling_table(self, node_name: str, type_key=None, return_free=False):
+        """
+        The table to draw node_name candidates from: all of them, or only the ones annotated
+        with type_key and/or without a nested Return. The pools are built on first use
+        """
+        table = self._sampling_tables.get(node_name)
+        if table is None:
+            # Not copied, so that tables attached to a SharedCorpus stay shared
+            example_ids = self.corpus.examples[node_name]
+            table = _SamplingTable(self._example_weights(node_name, example_ids))
+            self._sampling_tables[node_name] = table
+
+        if return_free:
+            if table.return_free is None:
+                returns = self.corpus.returns[node_name]
+                table.return_free = table.subset(
+                    [i for i in range(len(table.weights)) if not returns[i]]
+                )
+            table = table.return_free
+        if type_key is None:
+            return table
+
+        if table.buckets is None:
+            # type key -> the examples annotated with it
+            kept = defaultdict(list)
+            type_keys = self.corpus.type_keys[node_name]
+            for i in range(len(table.weights)):
+                type_key_id = type_keys[table.position(i)]
+                kept[self.corpus.strings[type_key_id]].append(i)
+            table.buckets = {k: table.subset(v) for k, v in kept.items()}
+        return table.buckets.get(type_key, _EMPTY_SAMPLING_TABLE)
+
+    def _strategy_strict_pairs(self, node_name):
+        rng = self.stream(node_name)
+        example_ids = self.corpus.examples[node_name]
+        free_name_ids = self.corpus.free_names[node_name]
+        name_sets = self.corpus.name_sets
+        returns = self.corpus.returns[node_name]
+        # the type of a Name is the one its id has in scope, rather than an annotation
+        typed_by_scope = node_name == "Name"
+
+        def _visit_strict_pairs(scope=None, type_key=None, return_free=False):
+            """
+            scope: if given, candidates with a free name that isn't in scope are skipped before
+                they're materialized. Yielded candidates carry their free names as _free_names
+            type_key: if given, only candidates of that type (see annotation_key) are drawn: the
+                ones annotated with it, or for Names the ones it's the type of in scope
+            return_free: only draw candidates without a nested Return. Yielded candidates carry
+                whether they contain one as _contains_return
+            """
+            if typed_by_scope:
+                table = self._sampling_table(node_name, None, return_free)
+            else:
+                table = self._sampling_table(node_name, type_key, return_free)
+
+            # Scopes numbered by this corpus' NameBits check a candidate's names with one AND
+            scope_mask = None
+            if (
+                isinstance(scope, Scope)
+                and scope.bits is self._name_bits
+                and len(scope.bits.masks) == len(name_sets)
+            ):
+                scope_mask = scope.mask()
+            masks = self._name_bits.masks
+            # position -> whether all of the example's names are in scope, checked in one batch
+            fits = None
+            if (
+                scope_mask is not None
+                and numpy is not None
+                and self.batch_min_examples is not None
+                and len(table.weights) >= self.batch_min_examples
+            ):
+                fits = self._batch_fits(node_name, scope_mask)
+            # whether names still have to be looked up in scope one by one
+            by_name = scope_mask is None or (typed_by_scope and type_key is not None)
+
+            # name set id -> whether all of its names are in scope (with the right type)
+            in_scope = {}
+            for position in table.draw(rng):
+                name_set_id = free_name_ids[position]
+                names = name_sets[name_set_id]
+                if scope is not None and names is not None:
+                    if fits is not None:
+                        if not fits[position]:
+                            continue
+                    elif scope_mask is not None:
+                        mask = masks[name_set_id]
+                        if (mask & scope_mask) != mask:
+                            continue
+                    if by_name:
+                        if name_set_id not in in_scope:
+                            in_scope[name_set_id] = (
+                                scope_mask is not None
+                                or all(name in scope for name in names)
+                            ) and (
+                                not typed_by_scope
+                                or type_key is None
+                                or all(scope[name] == type_key for name in names)
+                            )
+                        if not in_scope[name_set_id]:
+                            continue
+                candidate = self.corpus.materialize(example_ids[position])
+                candidate._free_names = names
+                candidate._contains_return = bool(returns[position])
+                yield candidate
 
         _visit_strict_pairs.name = node_name
         _visit_strict_pairs.__name__ = node_name
         return _visit_strict_pairs
 
+    def _batch_fits(self, node_name: str, scope_mask: int):
+        """
+        Whether each node_name example has all of its names in scope_mask, by position
+        """
+        table = self._sampling_table(node_name)
+        if table.name_matrix is None:
+            name_set_ids = numpy.frombuffer(
+                self.corpus.free_names[node_name], dtype=numpy.uintc
+            )
+            # one row per distinct name set of the node type
+            unique_ids, inverse = numpy.unique(name_set_ids, return_inverse=True)
+            table.name_matrix = self._name_bits.matrix(unique_ids.tolist()), inverse
+        matrix, inverse = table.name_matrix
+        return batch_fits(matrix, scope_mask)[inverse]
 
-def contains_return(element, top_level=None):
-    maybe_contained = deque([element])
 
-    MAX_ITERS = 10000
-    for i in range(MAX_ITERS):
-        if len(maybe_contained) == 0:
-            break
+_WEIGHTINGS = ("frequency", "uniform", "size")
 
-        element = maybe_contained.popleft()
-        if element is None:
-            return False
 
-        if isinstance(element, Return):
-            return True
+class _SamplingTable(object):
+    """
+    Draws the examples of one node type in a weighted random order, without repeats.
 
-        # From the AST, Statements that might contain Return (itself a statement that can't contain a Return)
-        #   FunctionDef(identifier name, arguments args,
-        #                stmt* body, expr* decorator_list, expr? returns,
-        #                string? type_comment)
-        #   | AsyncFunctionDef(identifier name, arguments args,
-        #                      stmt* body, expr* decorator_list, expr? returns,
-        #                      string? type_comment)
-        #   | ClassDef(identifier name,
-        #      expr* bases,
-        #      keyword* keywords,
-        #      stmt* body,
-        #      expr* decorator_list)
-        #   | For(expr target, expr iter, stmt* body, stmt* orelse, string? type_comment)
-        #   | AsyncFor(expr target, expr iter, stmt* body, stmt* orelse, string? type_comment)
-        #   | While(expr test, stmt* body, stmt* orelse)
-        #   | If(expr test, stmt* body, stmt* orelse)
-        #   | With(withitem* items, stmt* body, string? type_comment)
-        #   | AsyncWith(withitem* items, stmt* body, string? type_comment)
-        #   | Try(stmt* body, excepthandler* handlers, stmt* orelse, stmt* finalbody)
-
-        if (
-            isinstance(element, FunctionDef)
-            or isinstance(element, AsyncFunctionDef)
-            or isinstance(element, ClassDef)
-            or isinstance(element, With)
-            or isinstance(element, AsyncWith)
-        ):
-            maybe_contained.extend(element.body)
+    Draws come from an alias table (Vose's method) built once, so each one is O(1) whatever the
+    number of examples. Examples already drawn are rejected; once rejections pile up, i.e. most of
+    the weight has been drawn, the rest of the order is a weighted shuffle of what's left. Uniform
+    weights skip all this and use an incremental Fisher-Yates shuffle.
 
-        if (
-            isinstance(element, For)
-            or isinstance(element, AsyncFor)
-            or isinstance(element, While)
-            or isinstance(element, If)
-        ):
-            maybe_contained.extend(element.body)
-            maybe_contained.extend(element.orelse)
+    Examples with a weight of 0 are never drawn
+    """
 
-        if isinstance(element, Try):
-            maybe_contained.extend(element.body)
-            maybe_contained.extend(element.orelse)
-            maybe_contained.extend(element.finalbody)
+    # consecutive rejections before falling back to shuffling the remaining examples
+    max_rejections = 16
+
+    def __init__(self, weights, *, positions=None):
+        """
+        weights: of each example
+        positions: where the examples are among all the examples of the node type, for tables
+            of a subset of them. Defaults to all of them, in order
+        """
+        self.weights = weights
+        self.positions = positions
+        self.drawable = sum(1 for w in weights if w > 0)
+        self.uniform = self.drawable == len(weights) and len(set(weights)) <= 1
+        if not self.uniform:
+            self.probability, self.alias = _alias_table(weights)
+        # type key -> _SamplingTable of the examples with that type key, built on first use
+        self.buckets = None
+        # _SamplingTable of the examples without a nested Return, built on first use
+        self.return_free = None
+        # (NameBits.matrix of the examples' distinct name sets, row of each example), built on
+        # first use by BagOfConcepts._batch_fits
+        self.name_matrix = None
+
+    def position(self, i: int):
+        """
+        Where the i-th example of this table is among all the examples of the node type
+        """
+        return i if self.positions is None else self.positions[i]
+
+    def subset(self, kept):
+        """
+        A table of the examples at the given indexes of this one, keeping their weights
+        """
+        return _SamplingTable(
+            [self.weights[i] for i in kept],
+            positions=[self.position(i) for i in kept],
+        )
 
-    if i == MAX_ITERS - 1:
-        return True
+    def draw(self, rng: Random):
+        """
+        Yield the positions of the examples, in weighted random order
+        """
+        if self.positions is None:
+            return self._draw(rng)
+        return (self.positions[i] for i in self._draw(rng))
+
+    def _draw(self, rng: Random):
+        if self.uniform:
+            yield from _lazy_shuffle(rng, len(self.weights))
+            return
 
-    return False
+        probability = self.probability
+        alias = self.alias
+        n = len(probability)
+        seen = set()
+        rejected = 0
+        while len(seen) < self.drawable:
+            position = rng.randrange(n)
+            if rng.random() >= probability[position]:
+                position = alias[position]
+            if position in seen:
+                rejected += 1
+                if rejected > self.max_rejections:
+                    break
+                continue
+            rejected = 0
+            seen.add(position)
+            yield position
+
+        # Weighted shuffle (Efraimidis-Spirakis) of the examples that haven't come up yet
+        keys = {
+            position: rng.random() ** (1.0 / w)
+            for position, w in enumerate(self.weights)
+            if w > 0 and position not in seen
+        }
+        yield from sorted(keys, key=keys.__getitem__, reverse=True)
+
+
+_EMPTY_SAMPLING_TABLE = _SamplingTable([])
+
+
+def _alias_table(weights):
+    """
+    Vose's alias method. Draw a position uniformly, keep it with probability[position] and take
+    alias[position] otherwise: each position comes up with probability proportional to its weight
+    """
+    n = len(weights)
+    total = sum(weights)
+    probability = array("d", [1.0]) * n
+    alias = array("I", range(n))
+    if total <= 0:
+        return probability, alias
+
+    scaled = [w * n / total for w in weights]
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while len(small) > 0 and len(large) > 0:
+        less = small.pop()
+        more = large.pop()
+        probability[less] = scaled[less]
+        alias[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1.0
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    # what's left is 1 up to rounding
+    return probability, alias
+
+
+def _stream_seed(seed, *path):
+    """
+    Seed of the random stream at `path` under `seed`. Derived with a hash rather than by drawing
+    from a parent generator, so any stream can be split off directly and str hash randomization
+    doesn't make it differ between processes
+    """
+    digest = hashlib.sha256(repr((seed,) + path).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def _lazy_shuffle(rng: Random, n: int):
+    """
+    Yield range(n) in random order, one element per draw. An incremental Fisher-Yates shuffle
+    that only records the swapped positions, so nothing is allocated up front
+    """
+    swapped = {}
+    for i in range(n):
+        j = rng.randrange(i, n)
+        yield swapped.get(j, j)
+        current = swapped.pop(i, i)
+        if j != i:
+            swapped[j] = current
+
+
+# Fields holding the statements nested in a statement (or its handlers and match cases), which
+# is where a Return can be. Expressions never contain one
+_STATEMENT_LIST_FIELDS = ("body", "orelse", "finalbody", "handlers", "cases")
+
+
+def contains_return(element, top_level=None, memo=None):
+    """
+    Whether a Return is nested anywhere in the statements of element.
+
+    memo: optional dict of id(node) -> bool, shared between calls on nodes of the same tree so
+        nested statements that were already checked aren't walked again
+    """
+    if memo is not None and id(element) in memo:
+        return memo[id(element)]
+
+    result = False
+    maybe_contained = deque([element])
+    seen = set()
+    while len(maybe_contained) > 0:
+        current = maybe_contained.popleft()
+        if current is None or id(current) in seen:
+            continue
+        seen.add(id(current))
+
+        if isinstance(current, Return):
+            result = True
+            break
+        if memo is not None and current is not element and id(current) in memo:
+            if memo[id(current)]:
+                result = True
+                break
+            continue
+
+        for field in _STATEMENT_LIST_FIELDS:
+            statements = getattr(current, field, None)
+            if isinstance(statements, list):
+                maybe_contained.extend(statements)
+
+    if memo is not None:
+        memo[id(element)] = result
+    return result
+
+
+def target_names(target):
+    """
+    The names an assignment target binds. Attributes and subscripts bind none
+    """
+    names = []
+    stack = [target]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, Name):
+            names.append(current.id)
+        elif isinstance(current, (Tuple, List)):
+            stack.extend(reversed(current.elts))
+        elif isinstance(current, Starred):
+            stack.append(current.value)
+    return names
 
 
 def args_to_names(arguments):
@@ -506,293 +1802,492 @@ def args_to_names(arguments):
     return args
 
 
-def nested_unpack(element, top_level=None):
-    assert not isinstance(element, list)
+def nested_unpack(element, top_level=None, memo=None):
+    """
+    The names an element reads from its enclosing scope.
+
+    memo: optional dict of id(node) -> names, shared between calls on nodes of the same tree so
+        nested nodes that were already unpacked aren't walked again
+    """
+    # Post-order walk with an explicit stack, so deeply nested code doesn't hit the recursion
+    # limit. Each node's names come from its children's (see _unpack_rule)
+    stack = [(element, None, None)]
+    results = []
+    while stack:
+        node, rule, children = stack.pop()
+        if children is None:
+            if memo is not None and id(node) in memo:
+                results.append(memo[id(node)])
+                continue
+            rule = _unpack_rule(node)
+            if rule is _UNPACK_NAME:
+                names = [node.id]
+            elif rule is _UNPACK_NOTHING:
+                log.debug("Ending NotNameParent with no elements: %s" % (type(node)))
+                names = []
+            else:
+                children = rule.children(node)
+                stack.append((node, rule, children))
+                stack.extend((child, None, None) for child in reversed(children))
+                continue
+        else:
+            start = len(results) - len(children)
+            if rule.combine is None:
+                names = [name for names in results[start:] for name in names]
+            else:
+                names = rule.combine(node, results[start:])
+            del results[start:]
+        if memo is not None:
+            memo[id(node)] = names
+        results.append(names)
+    return results[0]
+
+
+class _UnpackRule(object):
+    """
+    How nested_unpack gets a node type's names: the concatenation of the names of its children,
+    unless combine(node, [names of each child]) says otherwise
+    """
+
+    __slots__ = ("children", "combine")
+
+    def __init__(self, children, combine=None):
+        """
+        children: the fields whose values are the children, in order, or a function of the node
+            returning the list of children
+        """
+        if not callable(children):
+            children = partial(_field_children, children)
+        self.children = children
+        self.combine = combine
+
+
+def _field_children(fields, node):
+    children = []
+    for field in fields:
+        value = getattr(node, field, None)
+        if isinstance(value, list):
+            children.extend(value)
+        else:
+            children.append(value)
+    return children
+
+
+def _ast_children(node):
+    return [
+        value
+        for value in _field_children(node._fields, node)
+        if value is None or isinstance(value, AST)
+    ]
+
+
+_UNPACK_NAME = _UnpackRule(())
+_UNPACK_NOTHING = _UnpackRule(())
+
+
+def _function_children(element):
+    # everything but the body is evaluated where the function is defined
+    args = element.args
+    return [
+        *element.decorator_list,
+        *[a.annotation for a in args_to_names(args)],
+        element.returns,
+        *args.defaults,
+        *args.kw_defaults,
+    ]
+
+
+def _arguments_children(element):
+    return [
+        *[a.annotation for a in args_to_names(element)],
+        *element.defaults,
+        *element.kw_defaults,
+    ]
+
+
+def _Lambda_children(element):
+    return [element.body, *element.args.defaults, *element.args.kw_defaults]
+
+
+def _Lambda_names(element, child_names):
+    # the body can use the arguments, the defaults are evaluated outside of the lambda
+    arg_names = {a.arg for a in args_to_names(element.args)}
+    body_names, *default_names = child_names
+    return [
+        *[name for name in body_names if name not in arg_names],
+        *[name for names in default_names for name in names],
+    ]
+
+
+# node type name -> _UnpackRule, see nested_unpack. Keyed by name like NotNameParent, as some of
+# the node types only exist in newer pythons
+_UNPACK_RULES = {
+    "Name": _UNPACK_NAME,
+    "Attribute": _UnpackRule(("value",)),
+    "Index": _UnpackRule(("value",)),
+    "Starred": _UnpackRule(("value",)),
+    "JoinedStr": _UnpackRule(("values",)),
+    "Subscript": _UnpackRule(("value", "slice")),
+    "Call": _UnpackRule(("func", "args", "keywords")),
+    "Lambda": _UnpackRule(_Lambda_children, _Lambda_names),
+    # Note: the body, orelse can be undefined depending on the result of the test, so taking
+    # the less strict approach here
+    "If": _UnpackRule(("test",)),
+    "IfExp": _UnpackRule(("test",)),
+    "While": _UnpackRule(("test",)),
+    # Note: cases are conditionally executed and can use the names their pattern captures
+    "Match": _UnpackRule(("subject",)),
+    "match_case": _UnpackRule(("pattern",)),
+    "MatchValue": _UnpackRule(("value",)),
+    "MatchSequence": _UnpackRule(("patterns",)),
+    "MatchMapping": _UnpackRule(("keys", "patterns")),
+    "MatchClass": _UnpackRule(("cls", "patterns", "kwd_patterns")),
+    "MatchAs": _UnpackRule(("pattern",)),
+    "MatchOr": _UnpackRule(("patterns",)),
+    "UnaryOp": _UnpackRule(("operand",)),
+    "BinOp": _UnpackRule(("left", "right")),
+    "BoolOp": _UnpackRule(("values",)),
+    "Compare": _UnpackRule(("left", "comparators")),
+    "Dict": _UnpackRule(("keys", "values")),
+    "Set": _UnpackRule(("elts",)),
+    # Note: elt, ifs may be defined by the generators
+    "ListComp": _UnpackRule(("generators",)),
+    "GeneratorExp": _UnpackRule(("generators",)),
+    "DictComp": _UnpackRule(("generators",)),
+    "SetComp": _UnpackRule(("generators",)),
+    "comprehension": _UnpackRule(("iter",)),
+    "Yield": _UnpackRule(("value",)),
+    "YieldFrom": _UnpackRule(("value",)),
+    "Await": _UnpackRule(("value",)),
+    "Return": _UnpackRule(("value",)),
+    "Expr": _UnpackRule(("value",)),
+    # the target is bound rather than read
+    "NamedExpr": _UnpackRule(("value",)),
+    "With": _UnpackRule(("items", "body")),
+    "AsyncWith": _UnpackRule(("items", "body")),
+    "withitem": _UnpackRule(("context_expr",)),
+    "ClassDef": _UnpackRule(("bases", "keywords", "decorator_list")),
+    "FunctionDef": _UnpackRule(_function_children),
+    "AsyncFunctionDef": _UnpackRule(_function_children),
+    "arguments": _UnpackRule(_arguments_children),
+    "arg": _UnpackRule(("annotation",)),
+    "keyword": _UnpackRule(("value",)),
+    "Assign": _UnpackRule(("value",)),
+    "AnnAssign": _UnpackRule(("annotation", "value")),
+    "AugAssign": _UnpackRule(("target", "value")),
+    # Note: handlers, orelse, finalbody conditionally executed and ignored
+    "Try": _UnpackRule(("body", "handlers")),
+    "TryStar": _UnpackRule(("body", "handlers")),
+    # Note: structurally like if
+    "Assert": _UnpackRule(("test",)),
+    "For": _UnpackRule(("iter", "body")),
+    "AsyncFor": _UnpackRule(("iter", "body")),
+    "List": _UnpackRule(("elts",)),
+    "Tuple": _UnpackRule(("elts",)),
+    "Raise": _UnpackRule(("exc", "cause")),
+    "Delete": _UnpackRule(("targets",)),
+    "FormattedValue": _UnpackRule(("value", "format_spec")),
+    "ExceptHandler": _UnpackRule(("type", "body")),
+    "Module": _UnpackRule(("body",)),
+    "Interactive": _UnpackRule(("body",)),
+    "Expression": _UnpackRule(("body",)),
+    "FunctionType": _UnpackRule(("argtypes", "returns")),
+    "Slice": _UnpackRule(("lower", "upper", "step")),
+    # declarations and imports bind names without reading any
+    "Global": _UNPACK_NOTHING,
+    "Nonlocal": _UNPACK_NOTHING,
+    "alias": _UNPACK_NOTHING,
+    "MatchSingleton": _UNPACK_NOTHING,
+    "MatchStar": _UNPACK_NOTHING,
+    "TypeIgnore": _UNPACK_NOTHING,
+}
+
+# node type -> _UnpackRule, resolved by _unpack_rule
+_unpack_rule_cache = {}
+
+
+def _unpack_rule(element):
+    node_type = type(element)
+    rule = _unpack_rule_cache.get(node_type)
+    if rule is not None:
+        return rule
+
+    if isinstance(element, NotNameParent) or len(getattr(node_type, "_fields", ())) == 0:
+        # constants, and statements like Continue that have nothing in them
+        rule = _UNPACK_NOTHING
+    else:
+        # subclasses unpack like the node type they extend
+        for base in node_type.__mro__:
+            if base.__name__ in _UNPACK_RULES:
+                rule = _UNPACK_RULES[base.__name__]
+                break
+    if rule is None:
+        # Syntax newer than these rules. Reading every name in it is stricter than needed (it
+        # may bind some of them), which only makes swaps rarer
+        log.debug("nested_unpack: no rule for %s, unpacking all of its children", node_type)
+        rule = _UnpackRule(_ast_children)
+    _unpack_rule_cache[node_type] = rule
+    return rule
+
+
+# node types whose candidates valid_swap doesn't check for names in scope
+_UNCHECKED_NAME_TYPES = {"Module", "arguments", "alias", "ImportFrom", "arg"}
+
+
+def free_names(node: AST, memo=None):
+    """
+    The names a candidate needs in scope for RandomizingTransformer.valid_swap to accept it, or
+    None if nested_unpack can't tell. Computed once per distinct example at ingestion
+
+    memo: passed on to nested_unpack
+    """
+    if type(node).__name__ in _UNCHECKED_NAME_TYPES:
+        return frozenset()
+    try:
+        return frozenset(nested_unpack(node, node, memo))
+    except Exception:
+        # nested_unpack doesn't cover every construct. Ingestion carries on, and valid_swap
+        # runs nested_unpack on the candidate if it's ever drawn
+        return None
+
+
+def annotation_key(annotation):
+    """
+    Canonical key of a type annotation, for matching typed swaps: `int`, `List[int]`, `a.B`,
+    `Dict[str, int]`, `int | None`. No annotation (or Any) is "Any". String forward references
+    key as the type they name
+    """
+    if annotation is None:
+        return "Any"
+    key = _annotation_key(annotation)
+    if key == "typing.Any":
+        return "Any"
+    return key
+
+
+def _annotation_key(annotation):
+    if isinstance(annotation, Name):
+        return annotation.id
+    elif isinstance(annotation, Attribute):
+        return "%s.%s" % (_annotation_key(annotation.value), annotation.attr)
+    elif isinstance(annotation, Subscript):
+        return "%s[%s]" % (
+            _annotation_key(annotation.value),
+            _annotation_key(annotation.slice),
+        )
+    elif isinstance(annotation, Index):
+        # before python3.9, subscripts wrapped their slice in an Index
+        return _annotation_key(annotation.value)
+    elif isinstance(annotation, (Tuple, List)):
+        keys = ", ".join(_annotation_key(elt) for elt in annotation.elts)
+        return keys if isinstance(annotation, Tuple) else "[%s]" % (keys,)
+    elif isinstance(annotation, Constant):
+        if isinstance(annotation.value, str):
+            return annotation.value
+        return repr(annotation.value)
+    elif isinstance(annotation, BinOp) and isinstance(annotation.op, BitOr):
+        return "%s | %s" % (
+            _annotation_key(annotation.left),
+            _annotation_key(annotation.right),
+        )
+    return dump(annotation)
+
+
+class _ScopeFrame(object):
+    """
+    One level of a Scope. Bindings are never overwritten: each name keeps the clock stamps it was
+    bound at and the values, so the frame can answer for any earlier point in time
+    """
+
+    __slots__ = ("parent", "fixed", "bindings", "mask")
+
+    def __init__(self, parent=None, fixed=None):
+        self.parent = parent
+        # names bound from the start, e.g. builtins
+        self.fixed = fixed
+        # name -> ([stamps], [values]), in binding order
+        self.bindings = {}
+        # bitset of the names currently bound in bindings, see NameBits
+        self.mask = 0
+
+
+_UNBOUND = object()
+
+
+def _scope_lookup(frame, at, name):
+    while frame is not None:
+        history = frame.bindings.get(name)
+        if history is not None:
+            stamps, values = history
+            if stamps[-1] <= at:
+                value = values[-1]
+            else:
+                i = bisect_right(stamps, at)
+                value = values[i - 1] if i > 0 else _UNBOUND
+            if value is not _UNBOUND:
+                return value
+        if frame.fixed is not None and name in frame.fixed:
+            return frame.fixed[name]
+        frame = frame.parent
+    return _UNBOUND
+
+
+def _scope_maps(frame, at):
+    maps = []
+    while frame is not None:
+        bound = dict(frame.fixed) if frame.fixed is not None else {}
+        for name, (stamps, values) in frame.bindings.items():
+            i = bisect_right(stamps, at)
+            if i > 0 and values[i - 1] is not _UNBOUND:
+                bound[name] = values[i - 1]
+        maps.append(bound)
+        frame = frame.parent
+    return maps
+
+
+class ScopeSnapshot(Mapping):
+    """
+    The names a Scope had at one point of generation, with their types. Taking one is O(1): it
+    shares the scope's frames and only sees what was bound before it was taken
+    """
+
+    __slots__ = ("_frame", "_at")
+
+    def __init__(self, frame: _ScopeFrame, at: int):
+        self._frame = frame
+        self._at = at
+
+    def __getitem__(self, name):
+        value = _scope_lookup(self._frame, self._at, name)
+        if value is _UNBOUND:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return _scope_lookup(self._frame, self._at, name) is not _UNBOUND
+
+    def __iter__(self):
+        seen = set()
+        for bound in self.maps:
+            for name in bound:
+                if name not in seen:
+                    seen.add(name)
+                    yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    @property
+    def maps(self):
+        """
+        The names bound in each frame, innermost first, like ChainMap.maps
+        """
+        return _scope_maps(self._frame, self._at)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.maps)
+
+
+class Scope(MutableMapping):
+    """
+    The names in scope during generation, with their types. A stack of frames like a ChainMap
+    (new_child, parents), whose current state can be captured with snapshot() in O(1) instead of
+    being copied.
+
+    Frames made from the same root share a clock which stamps every binding, so a snapshot is
+    just a frame and a time.
+
+    Given the corpus' NameBits, the scope also keeps a bitset of its names (see mask), so
+    checking that all of a candidate's names are in scope is a single AND
+    """
 
-    if isinstance(element, NotNameParent):
-        log.debug("Ending NotNameParent with no elements: %s" % (type(element)))
-        return []
-    elif isinstance(element, Name):
-        return [element.id]
-    elif (
-        isinstance(element, Attribute)
-        or isinstance(element, Index)
-        or isinstance(element, Starred)
-    ):
-        return nested_unpack(element.value, top_level)
-    elif isinstance(element, JoinedStr):
-
-        def flattened_JoinedStr():
-            for expr in element.values:
-                for eid in nested_unpack(expr, top_level):
-                    yield eid
-
-        return list(flattened_JoinedStr())
-    elif isinstance(element, Subscript):
-        return nested_unpack(element.value, top_level) + nested_unpack(
-            element.slice, top_level
+    __slots__ = ("_frame", "_clock", "bits")
+
+    def __init__(self, fixed=None, *, bits=None, _frame=None, _clock=None):
+        """
+        fixed: mapping of the names bound in the root frame from the start. Not copied, so it
+            mustn't change afterwards
+        bits: NameBits to keep the mask with
+        """
+        self._frame = _ScopeFrame(fixed=fixed) if _frame is None else _frame
+        # a list so that all the frames from the same root share it
+        self._clock = [0] if _clock is None else _clock
+        self.bits = bits
+
+    def __getitem__(self, name):
+        value = _scope_lookup(self._frame, self._clock[0], name)
+        if value is _UNBOUND:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return _scope_lookup(self._frame, self._clock[0], name) is not _UNBOUND
+
+    def __setitem__(self, name, value):
+        self._clock[0] += 1
+        history = self._frame.bindings.get(name)
+        if history is None:
+            self._frame.bindings[name] = ([self._clock[0]], [value])
+        else:
+            history[0].append(self._clock[0])
+            history[1].append(value)
+
+        if self.bits is not None:
+            bit = self.bits.bits.get(name)
+            if bit is not None:
+                if value is _UNBOUND:
+                    self._frame.mask &= ~(1 << bit)
+                else:
+                    self._frame.mask |= 1 << bit
+
+    def __delitem__(self, name):
+        # like ChainMap, only the innermost frame's bindings can be deleted
+        history = self._frame.bindings.get(name)
+        if history is None or history[1][-1] is _UNBOUND:
+            raise KeyError(name)
+        self[name] = _UNBOUND
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    @property
+    def maps(self):
+        return self.snapshot().maps
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.maps)
+
+    def new_child(self, fixed=None):
+        """
+        fixed: as for the root frame, names bound in the new frame from the start
+        """
+        return Scope(
+            bits=self.bits, _frame=_ScopeFrame(self._frame, fixed), _clock=self._clock
         )
-    elif isinstance(element, Call):
-
-        def flattened_Call():
-            for fid in nested_unpack(element.func, top_level):
-                yield fid
-            for arg in element.args:
-                for aid in nested_unpack(arg, top_level):
-                    yield aid
-            for keyword in element.keywords:
-                for kid in nested_unpack(keyword, top_level):
-                    yield kid
-
-        return list(flattened_Call())
-    elif isinstance(element, Lambda):
-        arg_names = set(args_to_names(element.args))
-        body_names = set(nested_unpack(element.body, top_level))
-        return [name for name in body_names - arg_names]
-    elif (
-        isinstance(element, If)
-        or isinstance(element, IfExp)
-        or isinstance(element, While)
-    ):
-        # Note: the body, orelse can be undefined depending on the result of the test, so taking the less strict approach here
-        return nested_unpack(element.test, top_level)
-    elif isinstance(element, UnaryOp):
-        return nested_unpack(element.operand, top_level)
-    elif isinstance(element, BinOp):
-        return [
-            *nested_unpack(element.left, top_level),
-            *nested_unpack(element.right, top_level),
-        ]
-    elif isinstance(element, BoolOp):
-
-        def flattened_BoolOp():
-            for v in element.values:
-                for vid in nested_unpack(v, top_level):
-                    yield vid
-
-        return list(flattened_BoolOp())
-    elif isinstance(element, Compare):
-
-        def flattened_Compare():
-            for lid in nested_unpack(element.left, top_level):
-                yield lid
-            for comparator in element.comparators:
-                for cid in nested_unpack(comparator, top_level):
-                    yield cid
-
-        return list(flattened_Compare())
-
-    elif isinstance(element, Dict):
-
-        def flattened_Dict():
-            for k in element.keys:
-                for kid in nested_unpack(k, top_level):
-                    yield kid
-            for v in element.values:
-                for vid in nested_unpack(v, top_level):
-                    yield vid
-
-        return list(flattened_Dict())
-    elif isinstance(element, Set):
-
-        def flattened_Set():
-            for k in element.elts:
-                for kid in nested_unpack(k, top_level):
-                    yield kid
-
-        return list(flattened_Set())
-    elif (
-        isinstance(element, ListComp)
-        or isinstance(element, GeneratorExp)
-        or isinstance(element, DictComp)
-        or isinstance(element, SetComp)
-    ):
 
-        def flattened_ListComp():
-            # Note: elt_id, ifs may be defined by the generators
-            # for elt_id in nested_unpack(element.elt, top_level):
-            #     yield elt_id
-
-            for gen in element.generators:
-                for gid in nested_unpack(gen, top_level):
-                    yield gid
-
-        return list(flattened_ListComp())
-    elif isinstance(element, comprehension):
-
-        def flattened_comprehension():
-            # names in ifs may be defined by other parts of the comprehension
-            # for if_ in element.ifs:
-            #     for ifid in nested_unpack(if_, top_level):
-            #         yield ifid
-            for iid in nested_unpack(element.iter, top_level):
-                yield iid
-
-        return list(flattened_comprehension())
-    elif isinstance(element, Yield) or isinstance(element, Return):
-        return nested_unpack(element.value, top_level)
-    elif isinstance(element, Expr):
-        return nested_unpack(element.value, top_level)
-    elif isinstance(element, With):
-
-        def flattened_With():
-            for withitem in element.items:
-                for cid in nested_unpack(withitem.context_expr, top_level):
-                    yield cid
-
-            for expr in element.body:
-                for eid in nested_unpack(expr, top_level):
-                    yield eid
-
-        return list(flattened_With())
-    elif isinstance(element, withitem):
-        return nested_unpack(element.context_expr, top_level)
-    elif isinstance(element, ClassDef):
-
-        def flattened_ClassDef():
-            for base in element.bases:
-                for eid in nested_unpack(base, top_level):
-                    yield eid
-
-            for decorator in element.decorator_list:
-                for did in nested_unpack(decorator, top_level):
-                    yield did
-
-            if len(element.keywords) > 0:
-                log.warning(element)
-                log.warning(ast_unparse(element))
-                log.warning(element.keywords)
-                log.warning(ast_unparse(element.keywords))
-                raise NotImplementedError("ClassDef with keywords")
-
-        return list(flattened_ClassDef())
-    elif isinstance(element, FunctionDef):
-
-        def flattened_FunctionDef():
-            for decorator in element.decorator_list:
-                for did in nested_unpack(decorator, top_level):
-                    yield did
-
-            all_args = [
-                *element.args.posonlyargs,
-                *element.args.args,
-                *element.args.kwonlyargs,
-            ]
-            if element.args.vararg is not None:
-                all_args.append(element.args.vararg)
-            if element.args.kwarg is not None:
-                all_args.append(element.args.kwarg)
-            for a in all_args:
-                for aid in nested_unpack(a.annotation, top_level):
-                    yield aid
-
-        return list(flattened_FunctionDef())
-    elif isinstance(element, keyword):
-        return nested_unpack(element.value, top_level)
-    elif isinstance(element, Assign):
-        return nested_unpack(element.value, top_level)
-    elif isinstance(element, AugAssign):
-        return nested_unpack(element.target, top_level) + nested_unpack(
-            element.value, top_level
-        )
-    elif isinstance(element, Try):
-        # Note: handlers, orelse, finalbody conditionally executed and ignored
-
-        def flattened_Try():
-            for expr in element.body:
-                for eid in nested_unpack(expr, top_level):
-                    yield eid
-            for excepthandler in element.handlers:
-                for eid in nested_unpack(excepthandler, top_level):
-                    yield eid
-
-        return list(flattened_Try())
-    elif isinstance(element, Assert):
-        # Note: structurally like if
-        return nested_unpack(element.test, top_level)
-    elif isinstance(element, For):
-
-        def flattened_For():
-            for iid in nested_unpack(element.iter, top_level):
-                yield iid
-            for stmt in element.body:
-                for sid in nested_unpack(stmt):
-                    yield sid
-
-        return list(flattened_For())
-    elif isinstance(element, List) or isinstance(element, Tuple):
-
-        def flattened_List():
-            for elem in element.elts:
-                for eid in nested_unpack(elem, top_level):
-                    yield eid
-
-        return list(flattened_List())
-    elif isinstance(element, Raise):
-        if element.cause is not None:
-            log.warning(element)
-            log.warning(ast_unparse(element))
-            log.warning(element.cause)
-            log.warning(ast_unparse(element.cause))
-            raise NotImplementedError("Raise with a cause")
-        return nested_unpack(element.exc)
-    elif isinstance(element, Delete):
-
-        def flattened_Delete():
-            for elem in element.targets:
-                for eid in nested_unpack(elem, top_level):
-                    yield eid
-
-        return list(flattened_Delete())
-    elif isinstance(element, FormattedValue):
-        return nested_unpack(element.value)
-    elif isinstance(element, ExceptHandler):
-
-        def flattened_ExceptHandler():
-            for tid in nested_unpack(element.type, top_level):
-                yield tid
-            for expr in element.body:
-                for eid in nested_unpack(expr, top_level):
-                    yield eid
-
-        return list(flattened_ExceptHandler())
-    elif isinstance(element, Module):
-
-        def flattened_Module():
-            for expr in element.body:
-                for eid in nested_unpack(expr, top_level):
-                    yield eid
-
-        return list(flattened_Module())
-    elif isinstance(element, Slice):
-
-        def flattened_Slice():
-            if element.lower is not None:
-                for lid in nested_unpack(element.lower, top_level):
-                    yield lid
-            if element.upper is not None:
-                for uid in nested_unpack(element.upper, top_level):
-                    yield uid
-            if element.step is not None:
-                for sid in nested_unpack(element.step, top_level):
-                    yield sid
-
-        return list(flattened_Slice())
+    @property
+    def parents(self):
+        return Scope(bits=self.bits, _frame=self._frame.parent, _clock=self._clock)
 
-    else:
-        log.warning("args unpacking?")
-        if top_level is not None:
-            log.warning("Top Level")
-            log.warning(top_level)
-            log.warning(ast_unparse(top_level))
-            log.warning("Element")
-        log.warning(element)
-        try:
-            log.warning(ast_unparse(element))
-            log.warning(element._fields)
-        except AttributeError:
-            pass
-        raise NotImplementedError("nested_unpack: Element %s" % (type(element),))
+    def snapshot(self):
+        return ScopeSnapshot(self._frame, self._clock[0])
+
+    def mask(self):
+        """
+        Bitset of the names in scope, numbered by self.bits. Names the corpus doesn't use have
+        no bit, so they're left out
+        """
+        mask = 0
+        frame = self._frame
+        while frame is not None:
+            mask |= frame.mask
+            if frame.fixed is not None:
+                mask |= self.bits.fixed_mask(frame.fixed)
+            frame = frame.parent
+        return mask
 
 
 def littering(name, to_name):
@@ -806,8 +2301,15 @@ def littering(name, to_name):
         @wraps(func)
         def wrapped(self, *args, **kwargs):
             result = func(self, *args, **kwargs)
+            if type(result).__name__ in _SHARED_NODE_TYPES:
+                # contexts and operators are shared by every tree, the corpus included
+                return result
             log.info("littering %s.%s with %s", result, to_name, name)
-            setattr(result, to_name, getattr(self, name))
+            value = getattr(self, name)
+            if isinstance(value, Scope):
+                # the scope as it is now, rather than the live one that keeps changing
+                value = value.snapshot()
+            setattr(result, to_name, value)
             return result
 
         return wrapped
@@ -844,6 +2346,10 @@ class RecursionCheckerVisitor(NodeVisitor):
         self.max_depth = max_depth
 
     def generic_visit(self, node):
+        if type(node).__name__ in _SHARED_NODE_TYPES:
+            # contexts and operators are shared singletons without children, never a loop
+            return
+
         self.depth += 1
 
         node_type = type(node)
@@ -874,17 +2380,56 @@ class RecursionCheckerVisitor(NodeVisitor):
 
 
 def loop_detection(ast):
-    checker = RecursionCheckerVisitor()
-    try:
-        checker.visit(ast)
-    except RecursionError as re:
-        log.debug("loop_detection: %s", re)
-        return True
+    """
+    Whether a node appears more than once in the tree (which includes it being its own
+    descendant), contexts and operators aside.
+
+    Generated trees can't have loops: every swap puts a freshly materialized candidate in the
+    tree, and materialize only shares the childless contexts and operators. So this is a debug
+    check rather than something generation relies on
+    """
+    visited = set()
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if type(node).__name__ in _SHARED_NODE_TYPES:
+            continue
+        if id(node) in visited:
+            log.debug("loop_detection: visited %s twice", node)
+            return True
+        visited.add(id(node))
+        stack.extend(_child_asts(node))
     return False
 
 
+# The names every program starts with in scope. Read-only and shared by all transformers
+_BUILTINS_SCOPE = MappingProxyType(
+    {"__random_code_return_ok": False, **dict.fromkeys(vars(builtins), "builtin")}
+)
+
+
+def globals_scope(globals_available):
+    """
+    A read-only scope layer of extra names generated code can use, e.g. the public API of the
+    package it's generated for
+
+    globals_available: mapping of name -> type (see annotation_key), or names whose type is
+        Any. Returned as is if it's already a layer
+    """
+    if isinstance(globals_available, MappingProxyType):
+        return globals_available
+    if isinstance(globals_available, Mapping):
+        return MappingProxyType(dict(globals_available))
+    return MappingProxyType(dict.fromkeys(globals_available, "Any"))
+
+
 class RandomizingTransformer(NodeTransformer):
-    def __init__(self, corpus, *, log_level=None, visit_only=False):
+    def __init__(
+        self, corpus, *, log_level=None, visit_only=False, globals_available=None
+    ):
+        """
+        globals_available: names in scope besides the builtins, see globals_scope
+        """
         if log_level is not None:
             log.setLevel(log_level)
 
@@ -898,13 +2443,9 @@ class RandomizingTransformer(NodeTransformer):
         self.missed_children = set()
 
         # This is where the craziness begins
-        self.scope = ChainMap(
-            {
-                "__random_code_return_ok": False,
-            }
-        )
-        for k in __builtins__:
-            self.scope[k] = "builtin"
+        self.scope = Scope(_BUILTINS_SCOPE, bits=corpus.name_bits())
+        if globals_available is not None:
+            self.scope = self.scope.new_child(globals_scope(globals_available))
         self.scope = self.scope.new_child()
 
         self.out_of_scope = set()
@@ -926,13 +2467,34 @@ class RandomizingTransformer(NodeTransformer):
     def depth_padding(self):
         return " " * self.depth
 
+    def _scope_snapshot(self):
+        if isinstance(self.scope, Scope):
+            return self.scope.snapshot()
+        return dict(self.scope)
+
+    def _return_ok(self):
+        return (
+            "__random_code_return_ok" in self.scope
+            and self.scope["__random_code_return_ok"]
+        )
+
+    def _swap_type_key(self, node_):
+        """
+        The type (see annotation_key) valid_swap requires of swaps for node_, or None for any
+        """
+        node_type = type(node_).__name__
+        if node_type == "arg":
+            type_key = annotation_key(node_.annotation)
+        elif node_type == "Name" and node_.id in self.scope:
+            type_key = self.scope[node_.id]
+        else:
+            return None
+        return None if type_key == "Any" else type_key
+
     def valid_swap(self, node_, proposed_swap):
         log.debug("valid_swap: %s for %s", str(node_), str(proposed_swap))
         assert type(node_) == type(proposed_swap)
 
-        if loop_detection(proposed_swap):
-            return False
-
         node_type = type(node_).__name__
         new_definitions = ["Module", "arguments"]
         if node_type in new_definitions:
@@ -942,11 +2504,12 @@ class RandomizingTransformer(NodeTransformer):
         if node_type in i_know_its_wrong:
             return True
 
-        if (
-            "__random_code_return_ok" not in self.scope
-            or not self.scope["__random_code_return_ok"]
-        ):
-            if contains_return(proposed_swap, proposed_swap):
+        if not self._return_ok():
+            # precomputed at ingestion for candidates from the corpus
+            returns = getattr(proposed_swap, "_contains_return", None)
+            if returns is None:
+                returns = contains_return(proposed_swap, proposed_swap)
+            if returns:
                 log.debug("invalid swap: return not ok but contains return")
                 return False
 
@@ -955,11 +2518,12 @@ class RandomizingTransformer(NodeTransformer):
                 # Heuristic because self has special usage
                 return False
 
-            if node_.annotation is None or node_.annotation.id == "Any":
+            type_key = annotation_key(node_.annotation)
+            if type_key == "Any":
                 return True
 
             # Note: Right now this is strictly equal type swapping vs allowing subtypes
-            return proposed_swap.annotation.id == node_.annotation.id
+            return annotation_key(proposed_swap.annotation) == type_key
 
         if node_type == "Name":
             if proposed_swap.id not in self.scope:
@@ -977,7 +2541,7 @@ class RandomizingTransformer(NodeTransformer):
             condition = proposed_swap.id in self.scope and (
                 type_to_match == "Any" or self.scope[proposed_swap.id] == type_to_match
             )
-            if condition:
+            if condition and log.isEnabledFor(logging.DEBUG):
                 log.debug(
                     self.depth_padding()
                     + "Good Swap %s and (%s or %s) scope: %s"
@@ -988,7 +2552,7 @@ class RandomizingTransformer(NodeTransformer):
                         self.scope.maps[:-1],
                     )
                 )
-            else:
+            elif not condition:
                 log.debug(
                     self.depth_padding()
                     + "Bad Swap %s and (%s or %s)"
@@ -1000,6 +2564,15 @@ class RandomizingTransformer(NodeTransformer):
                 )
             return condition
 
+        # precomputed at ingestion for candidates from the corpus, see free_names
+        names_to_check = getattr(proposed_swap, "_free_names", None)
+        if names_to_check is not None:
+            for name in names_to_check:
+                if name not in self.scope:
+                    self.out_of_scope.add(name)
+                    return False
+            return True
+
         if node_type == "Call":
             names_to_check = []
 
@@ -1046,6 +2619,13 @@ class RandomizingTransformer(NodeTransformer):
         return True
 
     def _helper_function_factory(self, node_name):
+        return partial(self._helper_function(node_name), self)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _helper_function(node_name):
+        # Built once per node type and bound to each transformer, so that making a transformer
+        # for every program stays cheap
         @littering("scope", "_ending_scope")
         @depth_protection
         def _visit_X(self, node_):
@@ -1062,7 +2642,11 @@ class RandomizingTransformer(NodeTransformer):
                 "arg",
             ]
 
-            for swapout in getattr(self.corpus, node_name)():
+            for swapout in getattr(self.corpus, node_name)(
+                scope=self.scope,
+                type_key=self._swap_type_key(node_),
+                return_free=not self._return_ok(),
+            ):
                 if self.visit_only:
                     continue
                 if self.valid_swap(node_, swapout):
@@ -1086,13 +2670,15 @@ class RandomizingTransformer(NodeTransformer):
                 for arg in args_to_names(swapout):
                     type_ = "Any"
                     if arg.annotation is not None:
-                        type_ = arg.annotation.id
+                        type_ = annotation_key(arg.annotation)
                     elif arg.type_comment is not None:
-                        type_ = arg.type_comment.id
-                        raise NotImplementedError("arg evaluation with a type comment")
+                        # the comment holds the annotation's source
+                        type_ = arg.type_comment.strip()
                     self.scope[arg.arg] = type_
                     log.debug("scope gains value %s from arg - arguments" % (arg.arg,))
-                    if arg.annotation is not None or arg.type_comment is not None:
+                    if log.isEnabledFor(logging.DEBUG) and (
+                        arg.annotation is not None or arg.type_comment is not None
+                    ):
                         log.debug(self.depth_padding() + "arguments - Typed Scope")
                         log.debug(self.depth_padding() + str(self.scope.maps[:-1]))
                 log.warning("_visit_X for arguments")
@@ -1100,7 +2686,7 @@ class RandomizingTransformer(NodeTransformer):
             result = self._post_visit(swapout)
 
             ## Start If Inspection
-            if node_name == "If":
+            if node_name == "If" and log.isEnabledFor(logging.DEBUG):
                 log.debug("\n===\nIf return evaluation")
                 log.debug(
                     "Start contains return %s, in scope %s, return ok %s",
@@ -1114,13 +2700,8 @@ class RandomizingTransformer(NodeTransformer):
                     contains_return(swapout, swapout),
                 )
                 log.debug(ast_unparse(swapout))
-            if (
-                "__random_code_return_ok" not in self.scope
-                or not self.scope["__random_code_return_ok"]
-            ):
-                if contains_return(swapout, swapout):
-                    if node_name == "If":
-                        log.debug("Skipping Due to Contains Return")
+                if not self._return_ok() and contains_return(swapout, swapout):
+                    log.debug("Skipping Due to Contains Return")
             ## End If Inspection
 
             log.debug(
@@ -1143,9 +2724,14 @@ class RandomizingTransformer(NodeTransformer):
 
         _visit_X.name = node_name
         _visit_X.__name__ = node_name
-        return partial(_visit_X, self)
+        return _visit_X
 
     def _ignore_function_factory(self, node_name):
+        return partial(self._ignore_function(node_name), self)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _ignore_function(node_name):
         @depth_protection
         def _visit_X_ignore(self, node_):
             result = self._post_visit(node_)
@@ -1153,12 +2739,16 @@ class RandomizingTransformer(NodeTransformer):
 
         _visit_X_ignore.name = node_name
         _visit_X_ignore.__name__ = node_name
-        return partial(_visit_X_ignore, self)
+        return _visit_X_ignore
 
     def _post_visit(self, node):
-        log.debug(
-            self.depth_padding() + type(node).__name__ + " " + str(self.scope.maps[:-1])
-        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                self.depth_padding()
+                + type(node).__name__
+                + " "
+                + str(self.scope.maps[:-1])
+            )
 
         result = NodeTransformer.generic_visit(self, node)
         assert result is not None
@@ -1192,15 +2782,17 @@ class RandomizingTransformer(NodeTransformer):
 
         # name
         def custom_scope_processor_FunctionDef(swapout):
-            self.scope.maps[1][swapout.name] = "FunctionDef"
-            log.debug(
-                self.depth_padding()
-                + "Scope after %s name %s"
-                % (
-                    "FunctionDef",
-                    self.scope.maps[:-1],
+            # the function's name is bound where it's defined, outside of its own scope
+            self.scope.parents[swapout.name] = "FunctionDef"
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(
+                    self.depth_padding()
+                    + "Scope after %s name %s"
+                    % (
+                        "FunctionDef",
+                        self.scope.maps[:-1],
+                    )
                 )
-            )
             return swapout
 
         return self._visit_impl(
@@ -1235,11 +2827,8 @@ class RandomizingTransformer(NodeTransformer):
             for withitem in swapout.items:
                 type_ = "Any"
                 if withitem.optional_vars is not None:
-                    vars_to_scope = withitem.optional_vars
-                    if isinstance(vars_to_scope, Name):
-                        self.scope[vars_to_scope.id] = type_
-                    else:
-                        raise NotImplementedError("Non-Name Assignment in With")
+                    for name in target_names(withitem.optional_vars):
+                        self.scope[name] = type_
             return swapout
 
         return self._visit_impl(
@@ -1285,7 +2874,7 @@ class RandomizingTransformer(NodeTransformer):
                     NodeTransformer.visit(self, getattr(swapout, member)),
                 )
                 assert getattr(swapout, member) is not None
-                getattr(swapout, member)._ending_scope = dict(self.scope)
+                getattr(swapout, member)._ending_scope = self._scope_snapshot()
             return swapout
 
         return self._visit_impl(
@@ -1322,13 +2911,6 @@ class RandomizingTransformer(NodeTransformer):
     @littering("scope", "_ending_scope")
     @depth_protection
     def visit_ClassDef(self, node_):
-        # Note: Debuggery for me
-        if len(node_.keywords) != 0:
-            print(ast_unparse(node_))
-            for idx, key in enumerate(node_.keywords):
-                print(idx, ast_unparse(key))
-            raise NotImplementedError("ClassDef with keywords")
-
         return self._visit_impl(
             node_,
             "ClassDef",
@@ -1374,7 +2956,11 @@ class RandomizingTransformer(NodeTransformer):
         if return_ok is not None:
             self.scope["__random_code_return_ok"] = return_ok
 
-        for swapout in getattr(self.corpus, node_name)():
+        for swapout in getattr(self.corpus, node_name)(
+            scope=self.scope,
+            type_key=self._swap_type_key(node_),
+            return_free=not self._return_ok(),
+        ):
             if self.valid_swap(node_, swapout):
                 # Let python scoping drop this variable
                 break
@@ -1385,14 +2971,15 @@ class RandomizingTransformer(NodeTransformer):
             )
             swapout = node_
 
-        log.debug(
-            self.depth_padding()
-            + "Scope at %s start %s"
-            % (
-                node_name,
-                self.scope.maps[:-1],
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                self.depth_padding()
+                + "Scope at %s start %s"
+                % (
+                    node_name,
+                    self.scope.maps[:-1],
+                )
             )
-        )
 
         if len(scope_order) > 0:
             for field, field_type in scope_order:
@@ -1406,7 +2993,7 @@ class RandomizingTransformer(NodeTransformer):
                             ),
                         )
                         assert getattr(swapout, field) is not None
-                        getattr(swapout, field)._ending_scope = dict(self.scope)
+                        getattr(swapout, field)._ending_scope = self._scope_snapshot()
                 elif field_type == "name":
                     if getattr(swapout, field) is not None:
                         # TODO(buck): Types instead of Any
@@ -1418,34 +3005,16 @@ class RandomizingTransformer(NodeTransformer):
                             self, getattr(swapout, field)[i]
                         )
                         assert getattr(swapout, field)[i] is not None
-                        getattr(swapout, field)[i]._ending_scope = dict(self.scope)
+                        getattr(swapout, field)[i]._ending_scope = self._scope_snapshot()
                 elif field_type == "multi-name":
                     for generator in getattr(swapout, field):
                         type_ = "Any"
-                        # Assignment Case
-                        if isinstance(generator, Name):
-                            self.scope[generator.id] = type_
                         # Generator case
-                        elif isinstance(generator.target, Name):
-                            self.scope[generator.target.id] = type_
-                        elif isinstance(generator.target, Tuple):
-                            for elt in generator.target.elts:
-                                if hasattr(elt, "id"):
-                                    self.scope[elt.id] = type_
-                        else:
-                            log.error(swapout)
-                            log.error(ast_unparse(swapout))
-                            log.error(field)
-                            log.error(field_type)
-                            log.error(generator)
-                            log.error(ast_unparse(generator))
-                            if hasattr(generator, "target"):
-                                log.error("target")
-                                log.error(generator.target)
-                                log.error(ast_unparse(generator.target))
-                            raise NotImplementedError(
-                                "Assignment in a multi-name to non-Names"
-                            )
+                        if isinstance(generator, comprehension):
+                            generator = generator.target
+                        # Assignment Case
+                        for name in target_names(generator):
+                            self.scope[name] = type_
                 elif field_type == "custom":
                     log.info(
                         self.depth_padding() + "scope_order selector custom: %s", field
@@ -1460,14 +3029,15 @@ class RandomizingTransformer(NodeTransformer):
         else:
             result = self._post_visit(swapout)
 
-        log.debug(
-            self.depth_padding()
-            + "Scope at %s end %s"
-            % (
-                node_name,
-                self.scope.maps[:-1],
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                self.depth_padding()
+                + "Scope at %s end %s"
+                % (
+                    node_name,
+                    self.scope.maps[:-1],
+                )
             )
-        )
         if new_scope:
             self.scope = self.scope.parents
 
@@ -1490,79 +3060,756 @@ class RandomizingTransformer(NodeTransformer):
         return result
 
 
-def the_sauce(gen: BagOfConcepts, start: Module, *, log_level=None):
-    transformer = RandomizingTransformer(gen, log_level=log_level)
+def the_sauce(
+    gen: BagOfConcepts, start: Module, *, log_level=None, globals_available=None
+):
+    transformer = RandomizingTransformer(
+        gen, log_level=log_level, globals_available=globals_available
+    )
     result = transformer.visit(start)
     assert result is not None
     # result = fix_missing_locations(result)
     return result
 
 
+def _read_file(corpus_file_path: str):
+    # bytes go straight to the parser, which handles the source encoding
+    with open(corpus_file_path, "rb") as f:
+        return f.read()
+
+
+_ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+
+def _is_archive(path: str):
+    return path.endswith(_ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+def _split_archive_path(path: str):
+    """
+    Split a path like `corpus.zip/pkg/mod.py` into the archive and the member path inside it.
+
+    Returns (None, None) if no parent of the path is an archive
+    """
+    archive = os.path.normpath(path)
+    member = []
+    while True:
+        archive, tail = os.path.split(archive)
+        if not tail:
+            return None, None
+        member.insert(0, tail)
+        if _is_archive(archive):
+            return archive, "/".join(member)
+
+
+class _ArchiveReader(object):
+    """
+    Reads .py members out of a zip or tar archive, keeping the archive open between reads
+    """
+
+    def __init__(self, archive_path: str):
+        if zipfile.is_zipfile(archive_path):
+            self._zip = zipfile.ZipFile(archive_path)
+            self._tar = None
+        else:
+            self._zip = None
+            self._tar = tarfile.open(archive_path, "r:*")
+
+    def members(self, prefix=""):
+        """Member paths of the .py files in the archive, in archive order"""
+        if self._zip is not None:
+            names = (i.filename for i in self._zip.infolist() if not i.is_dir())
+        else:
+            names = (i.name for i in self._tar if i.isfile())
+        for name in names:
+            if name.startswith(prefix) and name.endswith(".py"):
+                yield name
+
+    @property
+    def sequential(self):
+        """
+        Whether members are only cheap to read front to back. Seeking backwards in a compressed
+        tar decompresses it again from the start
+        """
+        return self._tar is not None
+
+    def read(self, member: str):
+        if self._zip is not None:
+            return self._zip.read(member)
+        ((_, contents),) = self.read_members([member])
+        return contents
+
+    def read_members(self, members):
+        """
+        Yield (member, contents) for each of the members. A zip's are read in the given order, a
+        tar's in archive order, in one pass
+        """
+        if self._zip is not None:
+            for member in members:
+                yield member, self._zip.read(member)
+            return
+
+        wanted = set(members)
+        for info in self._tar:
+            if info.name in wanted and info.isfile():
+                wanted.discard(info.name)
+                # by TarInfo, as extractfile(name) looks the member up from the end
+                with self._tar.extractfile(info) as f:
+                    yield info.name, f.read()
+                if len(wanted) == 0:
+                    return
+        if len(wanted) > 0:
+            raise KeyError("%s not found in the archive" % (sorted(wanted)[0],))
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._tar.close()
+
+
+def iter_sources(corpus):
+    """
+    Yield (path, file contents) for every file in the corpus, reading one file at a time.
+
+    Entries may be plain files, zip or tar archives (every .py member is read), paths to a member
+    inside an archive, as produced by find_files, or in-memory (name, source) pairs which are
+    passed through as is. Each archive is only opened once.
+
+    Files come in corpus order, except that the members of a tar archive that the corpus names
+    one by one are all read where the first of them is, in archive order: a compressed tar can
+    only be read efficiently front to back
+    """
+    archives = {}
+
+    def archive_reader(archive_path):
+        if archive_path not in archives:
+            archives[archive_path] = _ArchiveReader(archive_path)
+        return archives[archive_path]
+
+    # (entry, archive path, member path) for each corpus entry, the latter two None unless it's
+    # a member path
+    entries = []
+    # tar archive path -> {member path: corpus entry} for the member paths in the corpus
+    tar_members = defaultdict(dict)
+    for corpus_file_path in corpus:
+        archive_path = member = None
+        if not (
+            isinstance(corpus_file_path, tuple)
+            or _is_archive(corpus_file_path)
+            or os.path.isfile(corpus_file_path)
+        ):
+            archive_path, member = _split_archive_path(corpus_file_path)
+            if archive_path is not None and archive_reader(archive_path).sequential:
+                tar_members[archive_path][member] = corpus_file_path
+        entries.append((corpus_file_path, archive_path, member))
+
+    try:
+        for corpus_file_path, archive_path, member in entries:
+            if isinstance(corpus_file_path, tuple):
+                yield corpus_file_path
+            elif archive_path is not None:
+                reader = archive_reader(archive_path)
+                if not reader.sequential:
+                    yield corpus_file_path, reader.read(member)
+                elif archive_path in tar_members:
+                    member_paths = tar_members.pop(archive_path)
+                    for member, contents in reader.read_members(member_paths):
+                        yield member_paths[member], contents
+            elif _is_archive(corpus_file_path):
+                reader = archive_reader(corpus_file_path)
+                for member, contents in reader.read_members(reader.members()):
+                    yield os.path.join(corpus_file_path, member), contents
+            elif os.path.isfile(corpus_file_path):
+                yield corpus_file_path, _read_file(corpus_file_path)
+            else:
+                raise FileNotFoundError(corpus_file_path)
+    finally:
+        for reader in archives.values():
+            reader.close()
+
+
+# Bump when the unbundled format changes to invalidate existing cache entries
+_CACHE_VERSION = 6
+
+
+def _cache_path(cache_dir: str, corpus_file_path: str, file_contents):
+    key = hashlib.sha256()
+    key.update(
+        ("%d %d.%d\0" % (_CACHE_VERSION, *sys.version_info[:2])).encode("utf-8")
+    )
+    key.update(os.path.realpath(corpus_file_path).encode("utf-8", "surrogateescape"))
+    key.update(b"\0")
+    if isinstance(file_contents, str):
+        file_contents = file_contents.encode("utf-8", "surrogateescape")
+    key.update(file_contents)
+    return os.path.join(cache_dir, key.hexdigest() + ".pickle")
+
+
+def _load_cached(cache_path: str):
+    try:
+        with open(cache_path, "rb") as f:
+            return True, pickle.load(f)
+    except FileNotFoundError:
+        return False, None
+    except Exception as e:
+        log.warning("Ignoring unreadable cache entry %s: %s", cache_path, e)
+        return False, None
+
+
+def _store_cached(cache_path: str, elements):
+    # write then rename so that concurrent readers never see a partial entry
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(elements, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.warning("Failed to write cache entry %s: %s", cache_path, e)
+
+
+def _unbundle_source(source, cache_dir=None):
+    """
+    Parse and unbundle a single corpus file. Module level so that it can be sent to worker processes.
+
+    If cache_dir is set, the unbundled elements are loaded from (or stored to) an entry keyed by the
+    file path and contents, so unchanged files are never parsed twice.
+
+    source: (path, file contents)
+
+    Returns (path, unbundled elements, seconds spent), with None in place of the unbundled
+    elements if the file doesn't parse
+    """
+    start = time.perf_counter()
+    corpus_file_path, file_contents = source
+
+    if cache_dir is not None:
+        cache_path = _cache_path(cache_dir, corpus_file_path, file_contents)
+        hit, elements = _load_cached(cache_path)
+        if hit:
+            return corpus_file_path, elements, time.perf_counter() - start
+
+    try:
+        module = parse(file_contents, corpus_file_path, type_comments=True)
+        elements = unbundle_to_table(module)
+    except SyntaxError:
+        elements = None
+
+    if cache_dir is not None:
+        _store_cached(cache_path, elements)
+
+    return corpus_file_path, elements, time.perf_counter() - start
+
+
+def iter_asts(corpus):
+    """
+    Yield (path, Module) for every file in the corpus that parses, one file at a time.
+
+    Corpus entries are anything iter_sources accepts.
+    """
+    syntax_errors = []
+
+    for corpus_file_path, file_contents in iter_sources(corpus):
+        try:
+            yield corpus_file_path, parse(
+                file_contents, corpus_file_path, type_comments=True
+            )
+        except SyntaxError:
+            syntax_errors.append(corpus_file_path)
+
+    if len(syntax_errors) > 0:
+        log.debug("Syntax Mishaps")
+        log.debug(syntax_errors[:5])
+        log.debug("...")
+
+
 def make_asts(corpus: tList[str]):
-    ast_set = {}
+    return dict(iter_asts(corpus))
+
+
+def _bounded_map(executor, func, iterable, window: int):
+    """
+    Like executor.map, but only keeps `window` calls in flight so that the iterable is consumed
+    lazily instead of being read into memory up front
+    """
+    in_flight = deque()
+    for item in iterable:
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+        in_flight.append(executor.submit(func, item))
+    while len(in_flight) > 0:
+        yield in_flight.popleft().result()
+
+
+def iter_unbundled_files(corpus, *, workers=None, cache_dir=None, timings=None):
+    """
+    Parse and unbundle every file in the corpus, yielding (path, unbundled elements) in the order
+    iter_sources reads them, which is corpus order but for members of tar archives.
+
+    Files are read, parsed and unbundled one at a time and each module is dropped as soon as it's
+    unbundled, so peak memory beyond the unbundled output is bounded by the largest file (times the
+    number of files in flight).
+
+    With more than one worker the files are parsed and unbundled in a process pool. Results are
+    always yielded in the order of `corpus`, so the output is the same for any number of workers.
+    Files that don't parse are logged and skipped.
+
+    workers: number of worker processes, None for one per core, 1 to stay in this process
+    cache_dir: directory for per-file unbundled results, keyed by file path and contents
+    timings: optional dict, filled with path -> seconds spent parsing and unbundling that file
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    unbundle_source = partial(_unbundle_source, cache_dir=cache_dir)
 
     syntax_errors = []
 
-    for corpus_file_path in corpus:
-        with open(corpus_file_path) as f:
-            file_contents = []
-            for line in f:
-                file_contents.append(line)
-            try:
-                ast_set[corpus_file_path] = parse(
-                    "\n".join(file_contents), corpus_file_path, type_comments=True
-                )
-            except SyntaxError:
+    def skip_syntax_errors(per_file_results):
+        for corpus_file_path, elements, seconds in per_file_results:
+            if timings is not None:
+                timings[corpus_file_path] = seconds
+            if elements is None:
                 syntax_errors.append(corpus_file_path)
+                continue
+            yield corpus_file_path, elements
+
+    if workers <= 1:
+        yield from skip_syntax_errors(map(unbundle_source, iter_sources(corpus)))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from skip_syntax_errors(
+                _bounded_map(
+                    executor, unbundle_source, iter_sources(corpus), workers * 4
+                )
+            )
 
     if len(syntax_errors) > 0:
         log.debug("Syntax Mishaps")
         log.debug(syntax_errors[:5])
         log.debug("...")
 
-    return ast_set
 
+def unbundle_corpus(corpus, *, workers=None, cache_dir=None):
+    """
+    Parse and unbundle every file in the corpus into one CorpusTable, merging the per-file results
+    in corpus order.
+
+    See iter_unbundled_files for workers and cache_dir
+    """
+    unbundled = CorpusTable()
+
+    for _, elements in iter_unbundled_files(
+        corpus, workers=workers, cache_dir=cache_dir
+    ):
+        unbundled.extend(elements)
+
+    return unbundled
+
+
+def _estimated_ast_bytes(node_type: str):
+    """
+    Rough size of one live AST node of this type: the object plus its attribute dict
+    """
+    node = getattr(ast_module, node_type)()
+    for f in node._fields:
+        setattr(node, f, None)
+    for a in node._attributes:
+        setattr(node, a, 0)
+    return sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+
+
+def table_report(table: CorpusTable):
+    """
+    Per node type statistics for a CorpusTable.
+
+    Returns {node type: {
+        "count": occurrences in the corpus,
+        "distinct": distinct subtrees (after hash-consing),
+        "nodes": rows stored in the table (including nodes that are only children),
+        "table_bytes": bytes of the node type's rows, columns and lists in the table,
+        "ast_bytes": estimated bytes if each occurrence were a live AST node,
+    }}
+    """
+    per_node_bytes = table.node_type.itemsize + table.node_row.itemsize
+    rows_per_type = Counter(table.node_type)
+    report = {}
+    for type_code, node_type in enumerate(table.node_types):
+        fields = table.columns[node_type]
+        rows = rows_per_type[type_code]
+        table_bytes = rows * per_node_bytes
+        for column in fields.values():
+            table_bytes += len(column) * column.itemsize
+            for value in column:
+                if value & _TAG_MASK == _TAG_LIST:
+                    length = table.list_items[value >> _TAG_BITS]
+                    table_bytes += (1 + length) * table.list_items.itemsize
+
+        count = sum(table.weights.get(node_type, ()))
+        report[node_type] = {
+            "count": count,
+            "distinct": len(table.examples.get(node_type, ())),
+            "nodes": rows,
+            "table_bytes": table_bytes,
+            "ast_bytes": count * _estimated_ast_bytes(node_type),
+        }
+    return report
+
+
+def corpus_report(corpus, *, workers=1, cache_dir=None, trace_memory=True):
+    """
+    Ingest the corpus and report what it produced and what it cost.
+
+    Returns {
+        "files": {path: seconds spent parsing and unbundling},
+        "ingest_seconds": total wall time for the ingestion,
+        "peak_traced_bytes": peak memory allocated in this process during the ingestion, as seen
+            by tracemalloc (None with trace_memory=False, or if tracemalloc was already running),
+        "table_bytes": total size of the CorpusTable's arrays,
+        "node_types": table_report of the resulting table,
+    }
+
+    Workers and memory tracing both distort the per-file numbers, so the defaults are one worker
+    with tracing on. See iter_unbundled_files for workers and cache_dir
+    """
+    timings = {}
+    trace_memory = trace_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        table = CorpusTable()
+        for _, elements in iter_unbundled_files(
+            corpus, workers=workers, cache_dir=cache_dir, timings=timings
+        ):
+            table.extend(elements)
+        ingest_seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    node_types = table_report(table)
+    return {
+        "files": timings,
+        "ingest_seconds": ingest_seconds,
+        "peak_traced_bytes": peak,
+        "table_bytes": sum(
+            len(values) * values.itemsize for _, values in _shared_corpus_arrays(table)
+        ),
+        "node_types": node_types,
+    }
+
+
+def format_report(report, *, slowest_files=10):
+    """
+    Text rendering of a corpus_report, node types sorted by their size in the table
+    """
+    lines = [
+        "files: %d, ingest: %.2fs, table: %d bytes, peak traced: %s bytes"
+        % (
+            len(report["files"]),
+            report["ingest_seconds"],
+            report["table_bytes"],
+            report["peak_traced_bytes"],
+        ),
+        "",
+        "%-20s %10s %10s %10s %14s %14s"
+        % ("node type", "count", "distinct", "nodes", "table bytes", "ast bytes"),
+    ]
+    by_size = sorted(
+        report["node_types"].items(), key=lambda kv: kv[1]["table_bytes"], reverse=True
+    )
+    for node_type, stats in by_size:
+        lines.append(
+            "%-20s %10d %10d %10d %14d %14d"
+            % (
+                node_type,
+                stats["count"],
+                stats["distinct"],
+                stats["nodes"],
+                stats["table_bytes"],
+                stats["ast_bytes"],
+            )
+        )
+
+    lines.extend(["", "slowest files:"])
+    slowest = sorted(report["files"].items(), key=lambda kv: kv[1], reverse=True)
+    for path, seconds in slowest[:slowest_files]:
+        lines.append("%8.3fs %s" % (seconds, path))
+    return "\n".join(lines)
 
-def find_files(directory: str):
-    import os
 
+def find_files(directory: str):
+    """
+    Yield the paths of the .py files in a directory, a zip or tar archive, or a directory inside an
+    archive (e.g. `hypothesis.zip/hypothesis-master/`)
+    """
     directory = os.path.normpath(directory)
     directory = os.path.realpath(directory)
 
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for f in filenames:
-            if f.endswith(".py"):
-                yield os.path.join(dirpath, f)
+    if os.path.isdir(directory):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for f in filenames:
+                if f.endswith(".py"):
+                    yield os.path.join(dirpath, f)
+        return
+
+    if _is_archive(directory):
+        archive_path, prefix = directory, ""
+    else:
+        archive_path, prefix = _split_archive_path(directory)
+        if archive_path is None:
+            return
+        prefix = prefix + "/"
+
+    reader = _ArchiveReader(archive_path)
+    try:
+        for member in reader.members(prefix):
+            yield os.path.join(archive_path, member)
+    finally:
+        reader.close()
 
 
 class RandomCodeSource(object):
-    def __init__(self, corpus: tList[str], seed=1, *, log_level=None):
-        assert len(corpus) > 0
+    def __init__(
+        self,
+        corpus: tList[str],
+        seed=1,
+        *,
+        log_level=None,
+        workers=None,
+        cache_dir=None,
+        weighting="frequency",
+        temperature=1.0,
+        globals_available=None,
+    ):
+        """
+        See iter_unbundled_files for workers and cache_dir, which also apply to add_files. See
+        BagOfConcepts for weighting and temperature
+        globals_available: names generated code can use besides the builtins, see globals_scope
+        """
+        if log_level is not None:
+            log.setLevel(log_level)
+
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.globals_available = (
+            None if globals_available is None else globals_scope(globals_available)
+        )
+
+        # path -> {node type: {node id: occurrences}} each file added to the corpus
+        self._file_examples = {}
+
+        self._next_program = 0
+        self.gen = BagOfConcepts(
+            {}, seed=seed, weighting=weighting, temperature=temperature
+        )
+        self._add_files(corpus)
+        assert len(self._file_examples) > 0
+
+    @classmethod
+    def attach(
+        cls,
+        shared_name: str = None,
+        seed=1,
+        *,
+        path: str = None,
+        log_level=None,
+        weighting="frequency",
+        temperature=1.0,
+        globals_available=None,
+    ):
+        """
+        Generate from a corpus that another process put in a SharedCorpus, without copying it.
+        See SharedCorpus.attach for shared_name and path. The attached corpus is read-only, so
+        add_files and remove_files aren't available, and close() releases it
+        """
         if log_level is not None:
             log.setLevel(log_level)
 
-        ast_set = make_asts(corpus)
-        raw_materials = merge_unbundled_asts(ast_set.values())
-        self.gen = BagOfConcepts(raw_materials, seed=seed)
+        code_source = cls.__new__(cls)
+        code_source.workers = 1
+        code_source.cache_dir = None
+        code_source.globals_available = (
+            None if globals_available is None else globals_scope(globals_available)
+        )
+        code_source._file_examples = None
+        code_source._next_program = 0
+        code_source.gen = BagOfConcepts(
+            SharedCorpus.attach(shared_name, path=path),
+            seed=seed,
+            weighting=weighting,
+            temperature=temperature,
+        )
+        return code_source
+
+    def share(self, *, path=None):
+        """
+        Put this corpus in a SharedCorpus for other processes to attach to
+        """
+        return SharedCorpus(self.gen.corpus, path=path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Release the shared corpus an attached source maps. Does nothing for other sources
+        """
+        self.gen.corpus.close()
+
+    def _add_files(self, paths):
+        if self._file_examples is None:
+            raise ValueError("Attached to a shared corpus, which is read-only")
+        added_paths = []
+
+        def tracked_elements():
+            for corpus_file_path, elements in iter_unbundled_files(
+                paths, workers=self.workers, cache_dir=self.cache_dir
+            ):
+                added_paths.append(corpus_file_path)
+                yield elements
+
+        added = self.gen.add_elements(tracked_elements())
+        self._file_examples.update(zip(added_paths, added))
+
+    def add_files(self, paths: tList[str]):
+        """
+        Add files (or in-memory (name, source) pairs) to the live corpus. Files that are already in
+        the corpus are re-read, so this also picks up changes to existing files
+        """
+        paths = list(paths)
+        self.remove_files([p[0] if isinstance(p, tuple) else p for p in paths])
+        self._add_files(paths)
+
+    def remove_files(self, paths: tList[str]):
+        """
+        Remove files from the live corpus. Removing an archive or a directory removes every file
+        under it. Paths that aren't in the corpus are ignored
+        """
+        if self._file_examples is None:
+            raise ValueError("Attached to a shared corpus, which is read-only")
+
+        to_remove = []
+        for path in paths:
+            for corpus_file_path in self._file_examples:
+                if corpus_file_path == path or corpus_file_path.startswith(
+                    os.path.join(path, "")
+                ):
+                    to_remove.append(corpus_file_path)
+
+        for corpus_file_path in to_remove:
+            if corpus_file_path in self._file_examples:
+                self.gen.remove_elements(self._file_examples.pop(corpus_file_path))
+
+        if self.gen.corpus.wants_compaction():
+            node_ids = self.gen.compact()
+            self._file_examples = {
+                corpus_file_path: {
+                    node_type: {node_ids[node_id]: count for node_id, count in counts.items()}
+                    for node_type, counts in added.items()
+                }
+                for corpus_file_path, added in self._file_examples.items()
+            }
 
     def next_source(self):
-        starter_home = next(self.gen.Module())
-        result = the_sauce(self.gen, starter_home)
+        program = self._next_program
+        self._next_program += 1
+        return self.source_at(program)
+
+    def source_at(self, program: int):
+        """
+        Generate program number `program` for this seed. The result only depends on the corpus,
+        the seed and `program`, so it's the same whatever was generated before, and in whichever
+        thread or process
+        """
+        gen = self.gen.for_program(program)
+        starter_home = next(gen.Module())
+        result = the_sauce(
+            gen, starter_home, globals_available=self.globals_available
+        )
+
+        if log.isEnabledFor(logging.DEBUG) and loop_detection(result):
+            raise ValueError("Random code generation caused a cycle")
+
+        return ast_unparse(result)
+
+    def generate(self, programs, *, workers=1):
+        """
+        Generate each of the program numbers in `programs`, yielding the sources in that order.
+
+        With more than one worker, the corpus is put in a SharedCorpus and the programs are
+        generated in a process pool attached to it. The sources are the same as source_at's for
+        any number of workers.
+
+        workers: number of worker processes, None for one per core, 1 to stay in this process.
+            A callable weighting has to be picklable to be sent to the workers
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers <= 1:
+            for program in programs:
+                yield self.source_at(program)
+            return
+
+        with SharedCorpus(self.gen.corpus) as shared:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_attach_generation_worker,
+                initargs=(
+                    shared.name,
+                    self.gen.seed,
+                    log.level,
+                    self.gen.weighting,
+                    self.gen.temperature,
+                    # the read-only layer doesn't pickle
+                    None
+                    if self.globals_available is None
+                    else dict(self.globals_available),
+                ),
+            ) as executor:
+                yield from _bounded_map(
+                    executor, _generate_in_worker, programs, workers * 4
+                )
+
+
+# the RandomCodeSource each generation worker process attached to, see RandomCodeSource.generate
+_worker_code_source = None
 
-        # Five retries
-        for i in range(3):
-            try:
-                text_result = ast_unparse(result)
-                return text_result
-            except RecursionError as re:
-                log.error("Infinite Recursion suspected in result")
 
-        raise ValueError("Random code generation caused a cycle")
+def _attach_generation_worker(
+    shared_name: str, seed, log_level, weighting, temperature, globals_available
+):
+    global _worker_code_source
+    _worker_code_source = RandomCodeSource.attach(
+        shared_name,
+        seed,
+        log_level=log_level,
+        weighting=weighting,
+        temperature=temperature,
+        globals_available=globals_available,
+    )
+
+
+def _generate_in_worker(program: int):
+    return _worker_code_source.source_at(program)
 
 
 # todo: accept str or path
-def give_me_random_code(corpus: tList[str], *, log_level=None):
-    code_source = RandomCodeSource(corpus, log_level=log_level)
+def give_me_random_code(
+    corpus: tList[str], *, log_level=None, workers=None, cache_dir=None
+):
+    code_source = RandomCodeSource(
+        corpus, log_level=log_level, workers=workers, cache_dir=cache_dir
+    )
 
     text_result = code_source.next_source()
     return text_result
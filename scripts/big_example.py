@@ -2,9 +2,12 @@ from random_code import give_me_random_code, find_files
 
 
 def main():
-    # Download and unzip the latest hypothesis branch into the folder corpus_hypothesis
-    corpus_paths = find_files("corpus_hypothesis/hypothesis-master/hypothesis-python/")
-    random_source = give_me_random_code(sorted(list(corpus_paths)))
+    # Download the latest hypothesis branch as corpus_hypothesis/hypothesis-master.zip
+    # The archive is read in place, there's no need to unzip it
+    corpus_paths = find_files(
+        "corpus_hypothesis/hypothesis-master.zip/hypothesis-master/hypothesis-python/"
+    )
+    random_source = give_me_random_code(sorted(list(corpus_paths)), workers=None)
     print("### Randomly Generated Source")
 
     print("```python")
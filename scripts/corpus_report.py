@@ -0,0 +1,17 @@
+import sys
+
+from random_code import corpus_report, find_files, format_report
+
+
+def main():
+    # Usage: python3 scripts/corpus_report.py [directory or archive ...]
+    roots = sys.argv[1:] or ["corpus/"]
+    corpus_paths = []
+    for root in roots:
+        corpus_paths.extend(sorted(find_files(root)))
+
+    print(format_report(corpus_report(corpus_paths)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import pickle
+
 from random_code import find_files, RandomCodeSource
 
 
@@ -37,6 +39,20 @@ def test_RandomCodeSource_sequence(integer):
     exec_helper(random_source)
 
 
+def test_RandomCodeSource_leaves_corpus_untouched():
+    corpus_paths = list(find_files("corpus/"))
+    code_generator = RandomCodeSource(corpus_paths, seed=1234)
+    corpus = code_generator.gen.corpus
+    before = pickle.dumps(corpus)
+
+    for _ in range(20):
+        code_generator.next_source()
+
+    assert pickle.dumps(corpus) == before
+    # contexts and operators are shared between candidates, so they must not collect scopes
+    assert all(len(vars(node)) == 0 for node in corpus._singletons.values())
+
+
 def pytest_generate_tests(metafunc):
     if "integer" in metafunc.fixturenames:
         metafunc.parametrize("integer", range(1, 10))
@@ -0,0 +1,81 @@
+import os
+import tarfile
+import zipfile
+
+from random_code import find_files, iter_sources, unbundle_corpus, RandomCodeSource
+
+
+def _corpus_files():
+    return sorted(find_files("corpus/"))
+
+
+def _zip_corpus(tmp_path):
+    archive = str(tmp_path / "corpus.zip")
+    with zipfile.ZipFile(archive, "w") as zf:
+        for path in _corpus_files():
+            zf.write(path, "corpus-main/" + os.path.basename(path))
+        zf.writestr("corpus-main/README.md", "not python")
+    return archive
+
+
+def _tar_corpus(tmp_path):
+    archive = str(tmp_path / "corpus.tar.gz")
+    with tarfile.open(archive, "w:gz") as tf:
+        for path in _corpus_files():
+            tf.add(path, "corpus-main/" + os.path.basename(path))
+    return archive
+
+
+def test_find_files_in_archives(tmp_path):
+    for archive in [_zip_corpus(tmp_path), _tar_corpus(tmp_path)]:
+        expected = [
+            os.path.join(archive, "corpus-main", os.path.basename(p))
+            for p in _corpus_files()
+        ]
+
+        assert sorted(find_files(archive)) == expected
+        assert sorted(find_files(os.path.join(archive, "corpus-main"))) == expected
+        assert list(find_files(os.path.join(archive, "elsewhere"))) == []
+
+
+def test_unbundle_archives(tmp_path):
+    expected = unbundle_corpus(_corpus_files(), workers=1)
+
+    for archive in [_zip_corpus(tmp_path), _tar_corpus(tmp_path)]:
+        from_members = unbundle_corpus(sorted(find_files(archive)), workers=1)
+        assert from_members["FunctionDef"]["name"] == expected["FunctionDef"]["name"]
+
+        from_archive = unbundle_corpus([archive], workers=1)
+        assert sorted(from_archive["FunctionDef"]["name"]) == sorted(
+            expected["FunctionDef"]["name"]
+        )
+
+
+def test_tar_members_out_of_archive_order(tmp_path):
+    archive = str(tmp_path / "corpus.tar.gz")
+    with tarfile.open(archive, "w:gz") as tf:
+        for path in reversed(_corpus_files()):
+            tf.add(path, "corpus-main/" + os.path.basename(path))
+    members = sorted(find_files(archive))
+    assert len(members) > 1
+
+    read = list(iter_sources(["corpus/main.py", *members, "corpus/main.py"]))
+
+    # the tar's members are read together, in archive order
+    assert [path for path, _ in read] == [
+        "corpus/main.py",
+        *reversed(members),
+        "corpus/main.py",
+    ]
+    for path, contents in read[1:-1]:
+        with open(os.path.join("corpus", os.path.basename(path)), "rb") as f:
+            assert contents == f.read()
+
+
+def test_remove_archive(tmp_path):
+    archive = _zip_corpus(tmp_path)
+
+    code_source = RandomCodeSource([archive, "corpus/main.py"], seed=1234)
+    code_source.remove_files([archive])
+
+    assert code_source.gen.corpus["FunctionDef"]["name"] == ["main"]
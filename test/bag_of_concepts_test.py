@@ -0,0 +1,148 @@
+from ast import dump, parse
+from collections import Counter
+from random import Random
+
+import pytest
+
+from random_code.impl import (
+    BagOfConcepts,
+    Scope,
+    _alias_table,
+    _lazy_shuffle,
+    ast_unparse,
+    unbundle_to_table,
+)
+
+SOURCE = """
+def first(i: int):
+    return i
+
+
+def second(j: str):
+    return j
+"""
+
+
+def test_strategies_built_lazily():
+    gen = BagOfConcepts(unbundle_to_table(parse(SOURCE)), seed=0)
+
+    assert "FunctionDef" not in vars(gen)
+
+    names = sorted(f.name for f in gen.FunctionDef())
+    assert names == ["first", "second"]
+    assert "FunctionDef" in vars(gen)
+    assert "Return" not in vars(gen)
+
+    assert not hasattr(gen, "ClassDef")
+
+
+def test_strategies_invalidated_by_changes():
+    gen = BagOfConcepts(unbundle_to_table(parse(SOURCE)), seed=0)
+    list(gen.FunctionDef())
+
+    (added,) = gen.add_elements([unbundle_to_table(parse("def third():\n    pass"))])
+    assert "FunctionDef" not in vars(gen)
+    assert sorted(f.name for f in gen.FunctionDef()) == ["first", "second", "third"]
+
+    gen.remove_elements(added)
+    assert sorted(f.name for f in gen.FunctionDef()) == ["first", "second"]
+    assert not hasattr(gen, "Pass")
+
+
+def test_lazy_shuffle_is_a_permutation():
+    rng = Random(0)
+
+    assert sorted(_lazy_shuffle(rng, 1000)) == list(range(1000))
+    assert list(_lazy_shuffle(rng, 0)) == []
+
+
+def test_candidates_yielded_once_each():
+    source = "a\nb\nb\nb\nc\n"
+    gen = BagOfConcepts(unbundle_to_table(parse(source)), seed=0)
+
+    for _ in range(20):
+        candidates = [ast_unparse(expr).strip() for expr in gen.Expr()]
+        assert sorted(candidates) == ["a", "b", "c"]
+
+
+def _first_candidates(gen, programs=2000):
+    return Counter(
+        ast_unparse(next(gen.for_program(p).Expr())).strip() for p in range(programs)
+    )
+
+
+def test_weightings():
+    table = unbundle_to_table(parse("a\nb\nb\nb\nf(x, y + z)\n"))
+
+    frequency = _first_candidates(BagOfConcepts(table, seed=0))
+    assert frequency["b"] > frequency["a"] * 2
+
+    size = _first_candidates(BagOfConcepts(table, seed=0, weighting="size"))
+    assert size["a"] > size["f(x, y + z)"] * 2
+
+    rare = _first_candidates(BagOfConcepts(table, seed=0, temperature=-1))
+    assert rare["a"] > rare["b"] * 2
+
+    def no_calls(node_type, node_id, occurrences):
+        return 0 if "Call" in dump(table.materialize(node_id)) else 1
+
+    gen = BagOfConcepts(table, seed=0, weighting=no_calls)
+    assert sorted(ast_unparse(e).strip() for e in gen.Expr()) == ["a", "b"]
+
+
+def test_alias_table():
+    weights = [0, 1, 2, 5]
+    probability, alias = _alias_table(weights)
+
+    # each position's share: kept with probability[i], plus what the others alias to it
+    shares = [0.0] * len(weights)
+    for i in range(len(weights)):
+        shares[i] += probability[i] / len(weights)
+        shares[alias[i]] += (1 - probability[i]) / len(weights)
+    assert [round(s * sum(weights), 9) for s in shares] == weights
+
+
+def test_candidates_filtered_by_scope():
+    gen = BagOfConcepts(unbundle_to_table(parse("a\nb\nf(a)\nf(c)\n")), seed=0)
+
+    candidates = [ast_unparse(e).strip() for e in gen.Expr(scope={"a": "Any", "f": "Any"})]
+    assert sorted(candidates) == ["a", "f(a)"]
+
+
+def test_return_free_candidates():
+    source = "if a:\n    return 1\nif b:\n    pass\nif c:\n    for x in y:\n        return x\n"
+    gen = BagOfConcepts(unbundle_to_table(parse(source)), seed=0)
+
+    candidates = list(gen.If(return_free=True))
+    assert [ast_unparse(e).strip() for e in candidates] == ["if b:\n    pass"]
+    assert not candidates[0]._contains_return
+    assert sorted(e._contains_return for e in gen.If()) == [False, True, True]
+
+
+def test_scope_bitsets():
+    gen = BagOfConcepts(unbundle_to_table(parse("a\nb\nf(a)\nf(c)\n")), seed=0)
+    scope = Scope({"f": "builtin", "print": "builtin"}, bits=gen.name_bits()).new_child()
+    scope["a"] = "Any"
+    bits = scope.bits.bits
+
+    assert scope.mask() == (1 << bits["f"]) | (1 << bits["a"])
+    candidates = [ast_unparse(e).strip() for e in gen.Expr(scope=scope)]
+    assert sorted(candidates) == ["a", "f(a)"]
+
+    del scope["a"]
+    assert scope.mask() == 1 << bits["f"]
+
+
+def test_batch_scope_checks():
+    pytest.importorskip("numpy")
+    source = "".join("f(x%d)\n" % i for i in range(100))
+    scope = {"f": "Any", "x3": "Any", "x50": "Any"}
+
+    def candidates(batch_min_examples):
+        gen = BagOfConcepts(unbundle_to_table(parse(source)), seed=0)
+        gen.batch_min_examples = batch_min_examples
+        transformer_scope = Scope(scope, bits=gen.name_bits())
+        return [ast_unparse(e).strip() for e in gen.Expr(scope=transformer_scope)]
+
+    assert sorted(candidates(0)) == ["f(x3)", "f(x50)"]
+    assert candidates(0) == candidates(None)
@@ -0,0 +1,57 @@
+import os
+
+import random_code.impl
+from random_code import unbundle_corpus
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _counting_parse(monkeypatch):
+    parsed = []
+    real_parse = random_code.impl.parse
+
+    def parse(source, filename, **kwargs):
+        parsed.append(filename)
+        return real_parse(source, filename, **kwargs)
+
+    monkeypatch.setattr(random_code.impl, "parse", parse)
+    return parsed
+
+
+def test_cache_skips_unchanged_files(tmp_path, monkeypatch):
+    a = str(tmp_path / "a.py")
+    b = str(tmp_path / "b.py")
+    _write(a, "x = 1\n")
+    _write(b, "def f(i: int):\n    return i\n")
+    cache_dir = str(tmp_path / "cache")
+
+    parsed = _counting_parse(monkeypatch)
+
+    first = unbundle_corpus([a, b], workers=1, cache_dir=cache_dir)
+    assert parsed == [a, b]
+    assert len(os.listdir(cache_dir)) == 2
+
+    second = unbundle_corpus([a, b], workers=1, cache_dir=cache_dir)
+    assert parsed == [a, b]
+    assert sorted(first.keys()) == sorted(second.keys())
+    assert first["Name"]["id"] == second["Name"]["id"]
+
+    _write(b, "def g(j: str):\n    return j\n")
+    third = unbundle_corpus([a, b], workers=1, cache_dir=cache_dir)
+    assert parsed == [a, b, b]
+    assert third["FunctionDef"]["name"] == ["g"]
+
+
+def test_cache_keeps_syntax_errors(tmp_path, monkeypatch):
+    a = str(tmp_path / "a.py")
+    _write(a, "def (:\n")
+    cache_dir = str(tmp_path / "cache")
+
+    parsed = _counting_parse(monkeypatch)
+
+    assert len(unbundle_corpus([a], workers=1, cache_dir=cache_dir)) == 0
+    assert len(unbundle_corpus([a], workers=1, cache_dir=cache_dir)) == 0
+    assert parsed == [a]
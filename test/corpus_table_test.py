@@ -0,0 +1,148 @@
+import pickle
+
+from ast import dump, parse
+from collections import Counter
+
+from random_code.impl import (
+    CorpusTable,
+    ast_unparse,
+    merge_unbundled_asts,
+    unbundle_to_table,
+)
+
+SOURCE = """
+import os
+from typing import List
+
+
+def main(i: int, *args, scale=1.5, **kwargs) -> List[int]:
+    global counter
+    x = {"a": b"bytes", None: -0.0, 1j: ...}
+    if i > 10 ** 30:
+        return [x async for x in y]
+    return [f"{i!r:>10}", True, None]
+"""
+
+
+def test_materialize_roundtrip():
+    module = parse(SOURCE)
+    table = unbundle_to_table(module)
+
+    (module_id,) = table.examples["Module"]
+    assert dump(table.materialize(module_id)) == dump(module)
+
+
+def _dumped(value):
+    if isinstance(value, list):
+        return [_dumped(v) for v in value]
+    if hasattr(value, "_fields"):
+        return dump(value)
+    return value
+
+
+def test_matches_merge_unbundled_asts():
+    module = parse(SOURCE)
+    unbundled = merge_unbundled_asts([module])
+    table = CorpusTable.from_unbundled(unbundled)
+
+    non_empty = [
+        k for k, fields in unbundled.items() if len(fields) > 0 and all(fields.values())
+    ]
+    assert sorted(table.keys()) == sorted(non_empty)
+    for node_type in non_empty:
+        fields = unbundled[node_type]
+        # occurrences of the same subtree are grouped together, so compare as multisets
+        expected = Counter(repr(_dumped(list(v))) for v in zip(*fields.values()))
+        actual = Counter(
+            repr(_dumped(list(v))) for v in zip(*[table[node_type][f] for f in fields])
+        )
+        assert expected == actual
+
+
+def test_extend_and_pickle():
+    first = unbundle_to_table(parse("def f(i: int):\n    return i\n"))
+    second = unbundle_to_table(parse("def g(j: str):\n    return 'j'\n"))
+
+    table = CorpusTable()
+    added_first = table.extend(first)
+    table.extend(second)
+    assert table["FunctionDef"]["name"] == ["f", "g"]
+
+    loaded = pickle.loads(pickle.dumps(table))
+    assert _dumped(loaded["FunctionDef"]["body"]) == _dumped(
+        table["FunctionDef"]["body"]
+    )
+
+    table.remove_examples(added_first)
+    assert table["FunctionDef"]["name"] == ["g"]
+    assert table["arg"]["arg"] == ["j"]
+    assert "Return" in table
+
+
+def test_identical_subtrees_stored_once():
+    table = unbundle_to_table(parse("self.x = self.y\nself.x = None\nz = None\n"))
+
+    assert table["Name"]["id"] == ["self", "self", "self", "z"]
+    assert list(table.weights["Name"]) == [3, 1]
+    assert list(table.weights["Attribute"]) == [2, 1]
+    assert list(table.weights["Constant"]) == [2]
+
+    before = len(table.node_type)
+    table.extend(unbundle_to_table(parse("self.x = self.y\n")))
+    # Assign, Module and the Store context for the target already exist
+    assert len(table.node_type) == before + 1
+    assert list(table.weights["Name"]) == [5, 1]
+
+
+def test_subtree_sizes():
+    table = unbundle_to_table(parse("x\nf(x, x)\n"))
+
+    # Expr -> Name -> Load, and Expr -> Call -> 3 x (Name -> Load)
+    assert sorted(table.subtree_sizes(table.examples["Expr"])) == [3, 8]
+
+
+def _free_names_by_source(table, node_type):
+    return {
+        ast_unparse(table.materialize(node_id)).strip(): table.name_sets[name_set_id]
+        for node_id, name_set_id in zip(
+            table.examples[node_type], table.free_names[node_type]
+        )
+    }
+
+
+def test_free_names():
+    table = unbundle_to_table(parse("f(x, key=y.z)\nz = a[b:1]\n"))
+
+    assert _free_names_by_source(table, "Call") == {"f(x, key=y.z)": {"f", "x", "y"}}
+    assert _free_names_by_source(table, "Assign") == {"z = a[b:1]": {"a", "b"}}
+
+    merged = CorpusTable()
+    merged.extend(table)
+    shared = pickle.loads(pickle.dumps(merged))
+    assert _free_names_by_source(shared, "Call") == {"f(x, key=y.z)": {"f", "x", "y"}}
+
+
+def test_returns():
+    source = (
+        "def f():\n    return 1\n"
+        "for x in y:\n    if x:\n        pass\n"
+        "try:\n    pass\nexcept E:\n    return 2\n"
+    )
+    table = unbundle_to_table(parse(source))
+
+    def by_source(table, node_type):
+        return {
+            ast_unparse(table.materialize(node_id)).strip().split("\n")[0]: bool(returns)
+            for node_id, returns in zip(
+                table.examples[node_type], table.returns[node_type]
+            )
+        }
+
+    assert by_source(table, "FunctionDef") == {"def f():": True}
+    assert by_source(table, "For") == {"for x in y:": False}
+    assert by_source(table, "Try") == {"try:": True}
+
+    merged = CorpusTable()
+    merged.extend(table)
+    shared = pickle.loads(pickle.dumps(merged))
+    assert by_source(shared, "Try") == {"try:": True}
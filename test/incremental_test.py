@@ -0,0 +1,85 @@
+from random_code import RandomCodeSource
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _corpus_paths(tmp_path):
+    a = str(tmp_path / "a.py")
+    b = str(tmp_path / "b.py")
+    c = str(tmp_path / "c.py")
+    _write(a, "def first(i: int):\n    return i\n")
+    _write(b, "def second(j: int):\n    return j\n")
+    _write(c, "def third(k: int):\n    return k\n")
+    return a, b, c
+
+
+def test_add_files(tmp_path):
+    a, b, c = _corpus_paths(tmp_path)
+
+    incremental = RandomCodeSource([a], seed=1234)
+    incremental.add_files([b, c])
+
+    rebuilt = RandomCodeSource([a, b, c], seed=1234)
+
+    assert incremental.gen.corpus["FunctionDef"]["name"] == [
+        "first",
+        "second",
+        "third",
+    ]
+    assert incremental.next_source() == rebuilt.next_source()
+
+
+def test_remove_files(tmp_path):
+    a, b, c = _corpus_paths(tmp_path)
+
+    code_source = RandomCodeSource([a, b, c], seed=1234)
+    code_source.remove_files([b])
+
+    assert code_source.gen.corpus["FunctionDef"]["name"] == ["first", "third"]
+    assert code_source.gen.corpus["arg"]["arg"] == ["i", "k"]
+    for function_def in code_source.gen.FunctionDef():
+        assert function_def.name in ["first", "third"]
+
+    code_source.remove_files([a, c])
+    assert "FunctionDef" not in code_source.gen.corpus
+    assert not hasattr(code_source.gen, "FunctionDef")
+
+
+def test_add_files_rereads_changed_file(tmp_path):
+    a, b, c = _corpus_paths(tmp_path)
+
+    code_source = RandomCodeSource([a, b, c], seed=1234)
+    _write(b, "def changed(j: int):\n    return j\n")
+    code_source.add_files([b])
+
+    assert code_source.gen.corpus["FunctionDef"]["name"] == [
+        "first",
+        "third",
+        "changed",
+    ]
+
+
+def test_repeated_add_files_stays_bounded(tmp_path):
+    a, b, c = _corpus_paths(tmp_path)
+    code_source = RandomCodeSource([a, b], seed=1234)
+    corpus = code_source.gen.corpus
+    rows = len(corpus.node_type)
+
+    for i in range(200):
+        _write(c, "def third_%d(k: int):\n    return k + '%d'\n" % (i, i))
+        code_source.add_files([c])
+
+        # removed examples' rows, strings and constants are dropped now and then
+        assert len(corpus.node_type) <= 4 * rows
+        assert len(corpus.strings) <= 4 * rows
+        assert len(corpus.constants) <= 2
+
+    assert corpus["FunctionDef"]["name"] == ["first", "second", "third_199"]
+    code_source.remove_files([a])
+    assert sorted(corpus["FunctionDef"]["name"]) == ["second", "third_199"]
+    for function_def in code_source.gen.FunctionDef():
+        assert function_def.name in ["second", "third_199"]
+    code_source.next_source()
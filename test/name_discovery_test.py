@@ -1,12 +1,14 @@
 from random_code import nested_unpack
 
 from ast import (
+    Add,
     AugAssign,
     BinOp,
     BoolOp,
     Break,
     Call,
     Compare,
+    Constant,
     Dict,
     DictComp,
     Expr,
@@ -16,6 +18,7 @@ from ast import (
     JoinedStr,
     ListComp,
     Module,
+    Name,
     Pass,
     Raise,
     Return,
@@ -153,6 +156,15 @@ class Major(name):
     assert ["name"] == nested_unpack(ast)
 
 
+def test_ClassDef_keywords():
+    ast = str_to_ast(
+        """
+class Major(name, metaclass=meta):
+    pass"""
+    )
+    assert ["name", "meta"] == nested_unpack(ast)
+
+
 # Compare
 def test_Compare_none():
     ast = _strip_expr(str_to_ast("""True == False"""))
@@ -339,6 +351,11 @@ lambda x: name[0]
     assert ["name"] == nested_unpack(ast)
 
 
+def test_Lambda_args():
+    ast = _strip_expr(str_to_ast("lambda x, y=default: x + y + name"))
+    assert ["name", "default"] == nested_unpack(ast)
+
+
 # List
 def test_List_empty():
     ast = str_to_ast("[]")
@@ -385,6 +402,11 @@ def test_Raise():
     assert ["ValueError", "name"] == nested_unpack(ast)
 
 
+def test_Raise_cause():
+    ast = str_to_ast("raise ValueError(name) from error")
+    assert ["ValueError", "name", "error"] == nested_unpack(ast)
+
+
 # Return
 def test_Return():
     ast = str_to_ast("return name")
@@ -467,3 +489,52 @@ def test_UnaryOp():
     ast = _strip_expr(str_to_ast("-name"))
     assert isinstance(ast, UnaryOp)
     assert ["name"] == nested_unpack(ast)
+
+
+# Await, YieldFrom, NamedExpr
+def test_value_expressions():
+    for source in ["await name", "(yield from name)", "(x := name)"]:
+        ast = _strip_expr(str_to_ast(source))
+        assert ["name"] == nested_unpack(ast)
+
+
+# AnnAssign
+def test_AnnAssign():
+    ast = str_to_ast("x: kind = name")
+    assert ["kind", "name"] == nested_unpack(ast)
+
+
+# Global, Nonlocal, Continue
+def test_nothing_read():
+    for source in ["global name", "nonlocal name", "continue"]:
+        assert [] == nested_unpack(str_to_ast(source))
+
+
+# Match
+def test_Match():
+    ast = str_to_ast(
+        """
+match name:
+    case Point(x=0) | [1, *rest] | {"key": value}:
+        pass"""
+    )
+    assert ["name"] == nested_unpack(ast)
+    assert ["Point"] == nested_unpack(ast.cases[0])
+
+
+# Deep nesting
+def test_deeply_nested():
+    # deeper than the parser itself goes
+    ast = Name("name")
+    for _ in range(5000):
+        ast = BinOp(ast, Add(), Constant(1))
+    assert ["name"] == nested_unpack(ast)
+
+
+def test_memo_shared_between_calls():
+    ast = str_to_ast("x = f(a, b[c])")
+    memo = {}
+    call = ast.value
+    assert ["f", "a", "b", "c"] == nested_unpack(call, call, memo)
+    assert id(call.args[1]) in memo
+    assert ["f", "a", "b", "c"] == nested_unpack(ast, ast, memo)
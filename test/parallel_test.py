@@ -0,0 +1,59 @@
+from random_code import find_files, unbundle_corpus, RandomCodeSource
+
+from ast import dump
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _dumped(unbundled):
+    def dump_value(value):
+        if isinstance(value, list):
+            return [dump_value(v) for v in value]
+        if hasattr(value, "_fields"):
+            return dump(value)
+        return value
+
+    return {
+        node_type: {k: dump_value(v) for k, v in fields.items()}
+        for node_type, fields in unbundled.items()
+    }
+
+
+def test_parallel_matches_serial():
+    corpus_paths = sorted(find_files("corpus/"))
+
+    serial = unbundle_corpus(corpus_paths, workers=1)
+    parallel = unbundle_corpus(corpus_paths, workers=2)
+
+    assert _dumped(serial) == _dumped(parallel)
+
+
+def test_parallel_RandomCodeSource():
+    corpus_paths = sorted(find_files("corpus/"))
+
+    serial = RandomCodeSource(corpus_paths, seed=1234, workers=1)
+    parallel = RandomCodeSource(corpus_paths, seed=1234, workers=2)
+
+    assert serial.next_source() == parallel.next_source()
+
+
+def test_generation_reproducible_across_workers():
+    corpus_paths = sorted(find_files("corpus/"))
+    code_generator = RandomCodeSource(corpus_paths, seed=1234)
+
+    serial = [code_generator.next_source() for _ in range(6)]
+
+    assert [code_generator.source_at(k) for k in reversed(range(6))] == serial[::-1]
+    assert list(code_generator.generate(range(6), workers=2)) == serial
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert list(executor.map(code_generator.source_at, range(6))) == serial
+
+
+def test_generation_with_globals_across_workers():
+    corpus_paths = sorted(find_files("corpus/"))
+    code_generator = RandomCodeSource(
+        corpus_paths, seed=1234, globals_available=["np", "pd"]
+    )
+
+    serial = [code_generator.source_at(k) for k in range(4)]
+    assert list(code_generator.generate(range(4), workers=2)) == serial
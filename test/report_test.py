@@ -0,0 +1,25 @@
+from random_code import corpus_report, find_files, format_report
+
+
+def test_corpus_report():
+    corpus_paths = sorted(find_files("corpus/"))
+    report = corpus_report(corpus_paths)
+
+    assert sorted(report["files"]) == corpus_paths
+    assert report["peak_traced_bytes"] > 0
+    assert report["table_bytes"] > 0
+
+    name = report["node_types"]["Name"]
+    assert name["count"] >= name["distinct"] > 0
+    assert name["table_bytes"] > 0
+    assert name["ast_bytes"] > 0
+
+    # only appears as a child, never collected as an example
+    load = report["node_types"]["Load"]
+    assert load["count"] == 0
+    assert load["nodes"] == 1
+
+    text = format_report(report)
+    assert "FunctionDef" in text
+    for path in corpus_paths:
+        assert path in text
@@ -3,6 +3,7 @@ from random_code.impl import (
     BagOfConcepts,
     RandomizingTransformer,
     nested_unpack,
+    Scope,
 )
 
 from ast import (
@@ -18,6 +19,7 @@ from ast import (
     Lambda,
     ListComp,
     Module,
+    Name,
     SetComp,
     Try,
     With,
@@ -226,3 +228,37 @@ print(x)"""
     assert isinstance(result.body[0], ClassDef)
     assert "InterestingName" in result.body[0].body[0]._ending_scope
     assert "InterestingName" in result.body[1]._ending_scope
+
+
+def test_Scope_snapshots():
+    scope = Scope({"print": "builtin"}).new_child()
+    scope["x"] = "Any"
+    before = scope.snapshot()
+
+    inner = scope.new_child()
+    inner["y"] = "int"
+    inner.parents["f"] = "FunctionDef"
+    inner["x"] = "str"
+    during = inner.snapshot()
+    del inner["x"]
+
+    assert dict(before) == {"print": "builtin", "x": "Any"}
+    assert dict(during) == {"print": "builtin", "x": "str", "y": "int", "f": "FunctionDef"}
+    assert inner["x"] == "Any"
+    assert dict(scope) == {"print": "builtin", "x": "Any", "f": "FunctionDef"}
+    assert scope.maps[:-1] == [{"x": "Any", "f": "FunctionDef"}]
+
+
+def test_globals_available():
+    gen = BagOfConcepts(merge_unbundled_asts([str_to_ast("x", keep_module=True)]))
+
+    transformer = RandomizingTransformer(corpus=gen)
+    assert transformer.scope["print"] == "builtin"
+    assert not transformer.valid_swap(Name("x"), Name("np"))
+
+    transformer = RandomizingTransformer(
+        corpus=gen, globals_available={"np": "Any", "VERSION": "str"}
+    )
+    assert transformer.scope["print"] == "builtin"
+    assert transformer.scope["VERSION"] == "str"
+    assert transformer.valid_swap(Name("x"), Name("np"))
@@ -0,0 +1,69 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from random_code import find_files, RandomCodeSource, SharedCorpus
+
+
+def _generate(shared_name=None, path=None):
+    with RandomCodeSource.attach(shared_name, seed=1234, path=path) as code_source:
+        return [code_source.next_source() for _ in range(3)]
+
+
+def _expected():
+    code_source = RandomCodeSource(sorted(find_files("corpus/")), seed=1234)
+    return code_source, [code_source.next_source() for _ in range(3)]
+
+
+def test_attach_shared_memory():
+    code_source, expected = _expected()
+
+    with code_source.share() as shared:
+        attached = SharedCorpus.attach(shared.name)
+        assert attached["FunctionDef"]["name"] == code_source.gen.corpus[
+            "FunctionDef"
+        ]["name"]
+        attached.close()
+        # its arrays were views into the released mapping
+        with pytest.raises(ValueError):
+            attached.examples["FunctionDef"][0]
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(_generate, [shared.name, shared.name]))
+
+    assert results == [expected, expected]
+
+
+def test_attach_file(tmp_path):
+    code_source, expected = _expected()
+
+    shared = code_source.share(path=str(tmp_path / "corpus.bin"))
+    assert shared.name is None
+
+    assert _generate(path=shared.path) == expected
+
+    attached = RandomCodeSource.attach(path=shared.path)
+    try:
+        attached.add_files(["corpus/main.py"])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("attached corpus should be read-only")
+
+
+def test_attach_by_name_ignores_files(tmp_path, monkeypatch):
+    code_source, expected = _expected()
+    monkeypatch.chdir(tmp_path)
+
+    with code_source.share() as shared:
+        # a file in the working directory named like the segment isn't mapped instead
+        code_source.share(path=shared.name)
+        os.truncate(shared.name, 0)
+
+        assert _generate(shared.name) == expected
+
+    with pytest.raises(ValueError):
+        SharedCorpus.attach()
+    with pytest.raises(ValueError):
+        SharedCorpus.attach("name", path="path")
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from random_code import find_files, iter_asts, unbundle_corpus, RandomCodeSource
+from random_code.impl import _bounded_map
+
+
+def _in_memory_corpus():
+    for path in sorted(find_files("corpus/")):
+        with open(path, "rb") as f:
+            yield path, f.read()
+
+
+def test_in_memory_sources_match_files():
+    from_files = unbundle_corpus(sorted(find_files("corpus/")), workers=1)
+    from_memory = unbundle_corpus(_in_memory_corpus(), workers=1)
+
+    assert from_files["FunctionDef"]["name"] == from_memory["FunctionDef"]["name"]
+
+
+def test_source_lines_are_not_doubled():
+    (name, module), = iter_asts([("one.py", "x = 1\ny = 2\n")])
+
+    assert [stmt.lineno for stmt in module.body] == [1, 2]
+
+
+def test_str_and_bytes_sources():
+    code_source = RandomCodeSource(
+        [("a.py", "def f(i: int):\n    return i\n"), ("b.py", b"x = 1\n")], seed=1234
+    )
+
+    assert code_source.gen.corpus["FunctionDef"]["name"] == ["f"]
+
+
+def test_bounded_map_is_lazy():
+    consumed = []
+
+    def source():
+        for i in range(100):
+            consumed.append(i)
+            yield i
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = _bounded_map(executor, lambda x: x * 2, source(), 4)
+        assert next(results) == 0
+        assert len(consumed) <= 5
+        assert list(results) == [x * 2 for x in range(1, 100)]
@@ -3,6 +3,7 @@ from random_code.impl import (
     BagOfConcepts,
     RandomizingTransformer,
     loop_detection,
+    target_names,
 )
 
 from ast import (
@@ -25,7 +26,7 @@ from ast import (
     Tuple,
     With,
 )
-from ast import fix_missing_locations, NodeVisitor
+from ast import fix_missing_locations, NodeVisitor, parse
 from collections import ChainMap
 
 try:
@@ -92,7 +93,8 @@ def main():
 
     result = transformer.visit(main_func_def)
 
-    assert loop_detection(result)
+    # candidates are materialized from the corpus table, so they never alias each other
+    assert not loop_detection(result)
 
 
 def test_ListComp_elt_swaping():
@@ -137,3 +139,19 @@ def test_ListComp_generator_names_swaping():
                 print(f, getattr(gen, f), ast_unparse(getattr(gen, f)))
 
     assert transformer.valid_swap(result.generators[0].target, Tuple([Name("z")]))
+
+
+def test_loop_detection():
+    tree = parse("f(a, b)\n")
+    # the parser shares one Load between every name, which isn't a loop
+    assert not loop_detection(tree)
+
+    call = tree.body[0].value
+    call.args.append(call)
+    assert loop_detection(tree)
+
+
+def test_target_names():
+    (assign,) = parse("a.b, c[0], (d, [*e]) = f = x").body
+
+    assert [target_names(t) for t in assign.targets] == [["d", "e"], ["f"]]
@@ -1,6 +1,12 @@
-from random_code.impl import merge_unbundled_asts, BagOfConcepts, RandomizingTransformer
-
-from ast import Module, arg, Name
+from random_code.impl import (
+    annotation_key,
+    merge_unbundled_asts,
+    BagOfConcepts,
+    RandomizingTransformer,
+    unbundle_to_table,
+)
+
+from ast import Module, arg, Name, parse
 from collections import ChainMap
 
 
@@ -135,3 +141,51 @@ def test_name_typing_in_scope_nonmatching():
     transformer.scope = {"x": "int", "y": "FunctionDef"}
 
     assert not transformer.valid_swap(base, swap)
+
+
+def _arg(s):
+    return str_to_ast(s).args.args[0]
+
+
+def test_arg_typing_complex_annotations():
+    base = _arg("def x(i: List[int]):\n    pass")
+    same = _arg("def y(j: List[ int ]):\n    pass")
+    other = _arg("def y(j: a.B):\n    pass")
+    untyped = _arg("def y(j):\n    pass")
+
+    transformer = build_transformer()
+    transformer.scope = ChainMap({"List": "Type", "int": "Type", "a": "Any"})
+
+    assert transformer.valid_swap(base, same)
+    assert not transformer.valid_swap(base, other)
+    assert not transformer.valid_swap(base, untyped)
+
+
+def test_annotation_key():
+    for source, key in [
+        ("int", "int"),
+        ("List[int]", "List[int]"),
+        ("a.B", "a.B"),
+        ("Dict[str, int]", "Dict[str, int]"),
+        ("Optional['Foo']", "Optional[Foo]"),
+        ("int | None", "int | None"),
+        ("typing.Any", "Any"),
+    ]:
+        assert annotation_key(str_to_ast(source).value) == key
+    assert annotation_key(None) == "Any"
+
+
+def test_typed_candidates_drawn_from_bucket():
+    source = """
+def f(a: int, b: str, c: List[int], d):
+    pass
+"""
+    gen = BagOfConcepts(unbundle_to_table(parse(source)), seed=0)
+
+    assert [a.arg for a in gen.arg(type_key="List[int]")] == ["c"]
+    assert [a.arg for a in gen.arg(type_key="float")] == []
+
+    gen = BagOfConcepts(unbundle_to_table(parse("x\ny\nz\nw\n")), seed=0)
+    scope = ChainMap({"x": "int", "y": "str", "z": "int"})
+    names = gen.Name(scope=scope, type_key="int")
+    assert sorted(n.id for n in names) == ["x", "z"]
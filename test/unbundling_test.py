@@ -0,0 +1,53 @@
+from ast import AST, BinOp, parse, walk
+
+from random_code.impl import unbundle_ast, unbundle_to_table
+
+DEEP_SOURCE = "+".join(["1"] * 2000)
+
+
+def test_unbundle_deep_tree():
+    unbundled = unbundle_ast(parse(DEEP_SOURCE))
+
+    assert len(unbundled["BinOp"]["left"]) == 1999
+
+
+def test_table_deep_tree_roundtrip():
+    table = unbundle_to_table(parse(DEEP_SOURCE))
+
+    (module_id,) = table.examples["Module"]
+    module = table.materialize(module_id)
+    assert sum(isinstance(node, BinOp) for node in walk(module)) == 1999
+
+
+MODERN_SOURCE = """
+async def f(xs):
+    async with lock:
+        async for x in xs:
+            if (n := len(x)) > 3:
+                return n
+    match xs:
+        case [a, *rest]:
+            return a
+"""
+
+
+def test_unbundle_modern_syntax():
+    unbundled = unbundle_ast(parse(MODERN_SOURCE))
+
+    for node_type in ["AsyncWith", "AsyncFor", "NamedExpr", "Match", "match_case"]:
+        assert len(next(iter(unbundled[node_type].values()))) == 1
+
+
+class Custom(AST):
+    _fields = ("value",)
+
+
+def test_unknown_node_types_are_collected():
+    module = parse("x = 1")
+    module.body[0].value = Custom(value=module.body[0].value)
+
+    unbundled = unbundle_ast(module)
+    assert len(unbundled["Custom"]["value"]) == 1
+
+    table = unbundle_to_table(module)
+    assert len(table.examples["Custom"]) == 1